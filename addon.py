@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import urllib
+import time
+import itertools
 from urlparse import parse_qsl
 import json
 import re
 
+import xbmc
+
 from resources.lib.kodihelper import KodiHelper
+from resources.lib.searches import normalize_term
+from resources.lib.workers import map_parallel
 
 base_url = sys.argv[0]
 handle = int(sys.argv[1])
@@ -39,7 +46,7 @@ def list_pages():
     helper.add_item(helper.language(30007), params={'action': 'search'})
 
     # Show 'Oma Ruutu' only when user is logged in
-    if helper.r.get_credentials().get('accountId'):
+    if helper.r.credentials.account_id:
 
         params = {
             'action': 'list_grids',
@@ -69,6 +76,19 @@ def list_children_pages(children):
 
     helper.eod()
 
+def list_catalog_search_results(search_term, items):
+    watch_state = helper.r.get_watch_state() if helper.r.credentials.account_id else None
+    helper.set_total_items(len(items) + 1)
+    add_grid_items(items, helper.settings.ruutuplus_sticker, watch_state, None)
+
+    params = {
+        'action': 'search_remote',
+        'search_term': search_term
+    }
+    helper.add_item(helper.language(30034), params)
+
+    helper.eod()
+
 def list_search_result_grids(search_term):
     ruutu_params = {
         'offset': 0,
@@ -77,6 +97,7 @@ def list_search_result_grids(search_term):
 
     results = helper.r.get_grid_json('https://prod-component-api.nm-services.nelonenmedia.fi/api/component/336', json.dumps(ruutu_params))
 
+    categories = []
     for result in results['items']:
         # Hide empty categories
         if result['content']['hits'] > 0:
@@ -86,8 +107,11 @@ def list_search_result_grids(search_term):
                 'action': 'list_grid_content',
                 'url': result['content']['query']['url'],
                 'ruutu_params': json.dumps(result['content']['query']['params']),
-                'kodi_page': 1
+                'kodi_page': 1,
+                'offset': 0,
+                'limit': helper.page_sizer.size()
             }
+            categories.append(params)
 
             info = {
                 'plot': helper.language(30008) + str(result['content']['hits'])
@@ -97,6 +121,10 @@ def list_search_result_grids(search_term):
 
     helper.eod()
 
+    # First pages of the categories go to the response cache while the user picks one
+    map_parallel(lambda params: helper.r.get_grid_json(params['url'], params['ruutu_params'], offset=params['offset'],
+                                                       limit=params['limit']), categories, max_workers=4)
+
 # List Katsotuimmat, Ruutu suosittelee etc
 def list_grids(page_id, userroles):
     grids = helper.r.get_page_json('page', page_id, userroles)
@@ -108,38 +136,17 @@ def list_grids(page_id, userroles):
 
             # Jatka katsomista
             if 'user_unfinished_videos' in grid['content']['query']['params'].keys():
-                history = helper.r.get_page(
-                    'https://gatling.nelonenmedia.fi/storage/history?unfinished=true&gatling_token=' +
-                    helper.r.get_credentials()[
-                        'token'])
-
-                user_unfinished_videos = ''
-                for x in history:
-                    # Remove watched videos from list
-                    if x['unfinished'] is True:
-                        user_unfinished_videos+= ',' + str(x['video'])
-
                 ruutu_params = {
                     'offset': 0,
-                    'user_unfinished_videos': user_unfinished_videos
+                    'user_unfinished_videos': helper.r.get_watch_state().unfinished_videos()
 
                 }
 
             # Omat suosikit
             elif 'user_favorite_series' in grid['content']['query']['params'].keys():
-                favorite = helper.r.get_page(
-                    'https://gatling.nelonenmedia.fi/storage/favorite?gatling_token=' + helper.r.get_credentials()[
-                        'token'])
-
-                user_favorite_series = ''
-                for x in favorite:
-                    # Show only Ruutu favorites
-                    if x['type'] == 'series':
-                        user_favorite_series += ',' + str(x['item'])
-
                 ruutu_params = {
                     'offset': 0,
-                    'user_favorite_series': user_favorite_series
+                    'user_favorite_series': helper.r.get_watch_state().favorite_series()
 
                 }
 
@@ -158,243 +165,254 @@ def list_grids(page_id, userroles):
 
     helper.eod()
 
-def list_grid_content(url, ruutu_params, kodi_page):
-    page_size = helper.get_setting('items_per_page')
-    offset = (int(kodi_page) - 1) * int(page_size)
-
-    items = helper.r.get_grid_json(url, ruutu_params, offset=offset, limit=page_size)
-
-    # Load favorites and history only when user is logged in
-    if helper.r.get_credentials().get('accountId'):
-        favorite = helper.r.get_page('https://gatling.nelonenmedia.fi/storage/favorite?gatling_token=' + helper.r.get_credentials()['token'])
-        user_favorite_series = ",".join([str(x['item']) for x in favorite])
-
-        history = helper.r.get_page('https://gatling.nelonenmedia.fi/storage/history?unfinished=true&gatling_token=' + helper.r.get_credentials()['token'])
-        user_unfinished_videos = ",".join([str(x['video']) for x in history])
-
-    # Extra info for episodes
-    if json.loads(ruutu_params).get('current_series_id'):
-
-        ruutu_params2 = {
-            'current_primary_content': 'series',
-            'current_series_id': json.loads(ruutu_params)['current_series_id']
-        }
+def add_grid_item(item, ruutuplus_sticker, watch_state, live_video_ids, series_info):
+    """Add one grid item to the listing. watch_state is None when the user isn't logged in."""
+    if item['link']: # Movie or episode is available
+        # Movies and episodes
+        if item['link']['target']['type'] == 'video_id':
+            # Remove episode number from title
+            title = re.sub(r'\d+\ -', '', item['title']).lstrip()
+            # Remove agelimit from title
+            title = re.sub(r'\(.*?\)', '', title).rstrip()
+
+            if item['sticker'] == 'entertainment' and not ruutuplus_sticker:
+                list_title = title + ' [RUUTU+]'
+            else:
+                list_title = title
 
-        tvshow_extra_info = helper.r.get_grid_json('https://prod-component-api.nm-services.nelonenmedia.fi/api/component/26001', json.dumps(ruutu_params2))
+            params = {
+                'action': 'play',
+                'type': 'video',
+                'video_id': item['link']['target']['value'],
+                'sticker': item['sticker'] if item['sticker'] else None
+            }
 
-        genre = tvshow_extra_info['items'][0]['subtitle'].split(', ')
-        tvshowtitle = tvshow_extra_info['items'][0]['title']
+            info = {
+                'mediatype': 'episode',
+                'title': title,
+                'plot': item.get('description'),
+                'duration': item['timebar']['end'] if item.get('timebar') else None,
+                'aired': helper.r.unix_to_datetime(item['rights'][0]['start']) if item.get('rights') else None
+            }
 
-    for item in items['items']:
-        if item['link']: # Movie or episode is available
-            # Movies and episodes
-            if item['link']['target']['type'] == 'video_id':
-                # Remove episode number from title
-                title = re.sub(r'\d+\ -', '', item['title']).lstrip()
-                # Remove agelimit from title
-                title = re.sub(r'\(.*?\)', '', title).rstrip()
+            if item.get('tv_ratings'):
+                info['mpaa'] = item['tv_ratings']['agelimit'] if item['tv_ratings']['agelimit'] != 0 else None
+
+            # Watched status from Ruutu
+            if watch_state:
+                playcount, resume, total = watch_state.resume_info(item['link']['target']['value'],
+                                                                   item['timebar']['end'] if item.get('timebar') else None)
+                if playcount is not None:
+                    info['playcount'] = playcount
+            else: # User is not logged in, use Kodi internal resume points
+                resume = None
+                total = None
+
+            # Get extra info for episodes
+            if series_info:
+                info['tvshowtitle'] = series_info['tvshowtitle']
+                info['genre'] = series_info['genre']
+
+            # Get season and episode number from description
+            if item.get('description'):
+                pattern = re.compile(
+                    r"""(?:Kausi)(?:\s)(?P<s>\d+)(?:.*)(?:Jakso|\n)(?:\s)(?P<ep>\d+)""",
+                    re.VERBOSE)
+                se = re.search(pattern, item['description'])
+                if se:
+                    info['season'] = se.group('s')
+                    info['episode'] = se.group('ep')
+
+            if item.get('media'):
+                if item['media'].get('images'):
+                    item_art = {
+                        'fanart': helper.fanart_url(item['media']['images'].get('1920x1080'))
+                    }
 
-                if item['sticker'] == 'entertainment' and helper.get_setting('ruutuplus_sticker') is False:
-                    list_title = title + ' [RUUTU+]'
+                    if item['sticker'] == 'entertainment' and ruutuplus_sticker:
+                        item_art['thumb'] = helper.create_ruutuplus_thumb(item['media']['images']['640x360'])
+                    else:
+                        item_art['thumb'] = item['media']['images']['640x360']
                 else:
-                    list_title = title
+                    item_art = {}
+            else:
+                item_art = {}
 
-                params = {
-                    'action': 'play',
-                    'type': 'video',
-                    'video_id': item['link']['target']['value'],
-                    'sticker': item['sticker'] if item['sticker'] else None
-                }
+            helper.add_item(list_title, params=params, info=info, art=item_art, content='episodes', playable=True, resume=resume, total=total)
 
-                info = {
-                    'mediatype': 'episode',
-                    'title': title,
-                    'plot': item.get('description'),
-                    'duration': item['timebar']['end'] if item.get('timebar') else None,
-                    'aired': helper.r.unix_to_datetime(item['rights'][0]['start']) if item.get('rights') else None
-                }
+        # Tv-shows
+        if item['link']['target']['type'] == 'series_id':
 
-                if item.get('tv_ratings'):
-                    info['mpaa'] = item['tv_ratings']['agelimit'] if item['tv_ratings']['agelimit'] != 0 else None
-
-                # Watched status from Ruutu
-                if helper.r.get_credentials().get('accountId'):
-                    if str(item['link']['target']['value']) in user_unfinished_videos:
-                        for h in history:
-                            if h['video'] == item['link']['target']['value']:
-                                if h['unfinished'] is False: # Watched video
-                                    info['playcount'] = 1
-                                    resume = 0
-                                    total = item['timebar']['end']
-                                elif h['watched'] is None: # Unwatched video
-                                    info['playcount'] = 0
-                                    resume = 0
-                                    total = 1
-                                else: # Partly watched
-                                    resume = h['watched']
-                                    total = item['timebar']['end']
-                    else: # Unwatched video
-                        info['playcount'] = 0
-                        resume = 0
-                        total = 1
-                else: # User is not logged in, use Kodi internal resume points
-                    resume = None
-                    total = None
+            if item['sticker'] == 'entertainment' and not ruutuplus_sticker:
+                title = item['title'] + ' [RUUTU+]'
+            else:
+                title = item['title']
 
-                # Get extra info for episodes
-                if json.loads(ruutu_params).get('current_series_id'):
-                    info['tvshowtitle'] = tvshowtitle
-                    info['genre'] = genre
+            params = {
+                'action': 'list_seasons',
+                'series_id': item['id']
+            }
 
-                # Get season and episode number from description
-                if item.get('description'):
-                    pattern = re.compile(
-                        r"""(?:Kausi)(?:\s)(?P<s>\d+)(?:.*)(?:Jakso|\n)(?:\s)(?P<ep>\d+)""",
-                        re.VERBOSE)
-                    se = re.search(pattern, item['description'])
-                    if se:
-                        info['season'] = se.group('s')
-                        info['episode'] = se.group('ep')
+            info = {
+                'mediatype': 'tvshow',
+                'plot': item.get('description')
+            }
 
-                if item.get('media'):
-                    if item['media'].get('images'):
-                        item_art = {
-                            'fanart': item['media']['images']['1920x1080'] if item['media']['images'].get('1920x1080') else None
-                        }
+            # Show context menu only when user is logged in
+            if watch_state:
+                if not watch_state.is_favorite(item['id']):
+                    menu = []
+                    menu.append((helper.language(30015), 'RunPlugin(plugin://plugin.video.ruutu/?action=add_favorite&series_id=' + str(item['id']) + ')',))
+                else:
+                    menu = []
+                    menu.append((helper.language(30016), 'RunPlugin(plugin://plugin.video.ruutu/?action=remove_favorite&series_id=' + str(item['id']) + ')',))
+            else:
+                menu = None
 
-                        if item['sticker'] == 'entertainment' and helper.get_setting('ruutuplus_sticker'):
-                            item_art['thumb'] = helper.create_ruutuplus_thumb(item['media']['images']['640x360'],
-                                                                              item['link']['target']['value'])
-                        else:
-                            item_art['thumb'] = item['media']['images']['640x360']
+            if item.get('media'):
+                if item['media'].get('images'):
+                    item_art = {
+                        'fanart': helper.fanart_url(item['media']['images'].get('1920x1080'))
+                    }
+
+                    if item['sticker'] == 'entertainment' and ruutuplus_sticker:
+                        item_art['thumb'] = helper.create_ruutuplus_thumb(item['media']['images']['640x360'])
                     else:
-                        item_art = {}
+                        item_art['thumb'] = item['media']['images']['640x360']
                 else:
                     item_art = {}
+            else:
+                item_art = {}
 
-                helper.add_item(list_title, params=params, info=info, art=item_art, content='episodes', playable=True, resume=resume, total=total)
+            helper.add_item(title, params, info=info, art=item_art, content='tvshows', menu=menu)
 
-            # Tv-shows
-            if item['link']['target']['type'] == 'series_id':
+        # Channels
+        if item['link']['target']['type'] == 'channel_id':
+            channel_name = item['title_detail']
+            show_name = item['title_time'] + ' ' + item['title']
 
-                if item['sticker'] == 'entertainment' and helper.get_setting('ruutuplus_sticker') is False:
-                    title = item['title'] + ' [RUUTU+]'
-                else:
-                    title = item['title']
+            if item['sticker'] == 'entertainment' and not ruutuplus_sticker:
+                title = channel_name + ' [RUUTU+]'
+            else:
+                title = channel_name
 
-                params = {
-                    'action': 'list_seasons',
-                    'series_id': item['id']
-                }
+            video_id = live_video_ids.get(('channel_id', item['link']['target']['value']))
+            if not video_id:
+                return
 
-                info = {
-                    'mediatype': 'tvshow',
-                    'plot': item.get('description')
-                }
+            params = {
+                'action': 'play',
+                'type': 'live',
+                'video_id': video_id,
+                'sticker': item['sticker'] if item['sticker'] else None
+            }
 
-                # Show context menu only when user is logged in
-                if helper.r.get_credentials().get('accountId'):
-                    if str(item['id']) not in user_favorite_series:
-                        menu = []
-                        menu.append((helper.language(30015), 'RunPlugin(plugin://plugin.video.ruutu/?action=add_favorite&series_id=' + str(item['id']) + '&gatling_token=' + helper.r.get_credentials()['token'] + ')',))
-                    else:
-                        menu = []
-                        menu.append((helper.language(30016), 'RunPlugin(plugin://plugin.video.ruutu/?action=remove_favorite&series_id=' + str(item['id']) + '&gatling_token=' + helper.r.get_credentials()['token'] + ')',))
-                else:
-                    menu = None
+            info = {
+                'mediatype': 'video',
+                'title': channel_name,
+                'plot': show_name
+            }
 
-                if item.get('media'):
-                    if item['media'].get('images'):
-                        item_art = {
-                            'fanart': item['media']['images']['1920x1080'] if item['media']['images'].get('1920x1080') else None
-                        }
+            if item.get('media'):
+                if item['media'].get('images'):
+                    item_art = {
+                        'fanart': helper.fanart_url(item['media']['images'].get('1920x1080'))
+                    }
 
-                        if item['sticker'] == 'entertainment' and helper.get_setting('ruutuplus_sticker'):
-                            item_art['thumb'] = helper.create_ruutuplus_thumb(item['media']['images']['640x360'],
-                                                                          item['id'])
-                        else:
-                            item_art['thumb'] = item['media']['images']['640x360']
+                    if item['sticker'] == 'entertainment' and ruutuplus_sticker:
+                        item_art['thumb'] = helper.create_ruutuplus_thumb(item['media']['images']['640x360'])
                     else:
-                        item_art = {}
+                        item_art['thumb'] = item['media']['images']['640x360']
                 else:
                     item_art = {}
+            else:
+                item_art = {}
 
-                helper.add_item(title, params, info=info, art=item_art, content='tvshows', menu=menu)
-
-            # Channels
-            if item['link']['target']['type'] == 'channel_id':
-                channel_name = item['title_detail']
-                show_name = item['title_time'] + ' ' + item['title']
+            helper.add_item(title, params=params, info=info, art=item_art, content='videos', playable=True)
 
-                if item['sticker'] == 'entertainment' and helper.get_setting('ruutuplus_sticker') is False:
-                    title = channel_name + ' [RUUTU+]'
-                else:
-                    title = channel_name
+        # Sport streams
+        if item['link']['target']['type'] == 'stream_id':
+            if item['sticker'] == 'entertainment' and not ruutuplus_sticker:
+                title = item['title_time'] + ' ' + item['title'] + ' [RUUTU+]'
+            else:
+                title = item['title_time'] + '' + item['title']
 
-                video_id =  helper.r.get_page_json('channel', item['link']['target']['value'], helper.check_userrole())['components'][0]['content']['items'][0]['content']['items'][0]['video_id']
+            video_id = live_video_ids.get(('stream_id', item['link']['target']['value']))
+            if not video_id:
+                return
 
-                params = {
-                    'action': 'play',
-                    'type': 'live',
-                    'video_id': video_id,
-                    'sticker': item['sticker'] if item['sticker'] else None
-                }
+            params = {
+                'action': 'play',
+                'type': 'live',
+                'video_id': video_id,
+                'sticker': item['sticker'] if item['sticker'] else None
+            }
 
-                info = {
-                    'mediatype': 'video',
-                    'title': channel_name,
-                    'plot': show_name
-                }
+            info = {
+                'mediatype': 'video',
+                'title': item['title'],
+                'plot': item.get('description')
+            }
 
-                if item.get('media'):
-                    if item['media'].get('images'):
-                        item_art = {
-                            'fanart': item['media']['images']['1920x1080'] if item['media']['images'].get('1920x1080') else None
-                        }
+            if item.get('media'):
+                if item['media'].get('images'):
+                    item_art = {
+                        'fanart': helper.fanart_url(item['media']['images'].get('1920x1080'))
+                    }
 
-                        if item['sticker'] == 'entertainment' and helper.get_setting('ruutuplus_sticker'):
-                            item_art['thumb'] = helper.create_ruutuplus_thumb(item['media']['images']['640x360'],
-                                                                              video_id)
-                        else:
-                            item_art['thumb'] = item['media']['images']['640x360']
+                    if item['sticker'] == 'entertainment' and ruutuplus_sticker:
+                        item_art['thumb'] = helper.create_ruutuplus_thumb(item['media']['images']['640x360'])
                     else:
-                        item_art = {}
+                        item_art['thumb'] = item['media']['images']['640x360']
                 else:
                     item_art = {}
+            else:
+                item_art = {}
 
-                helper.add_item(title, params=params, info=info, art=item_art, content='videos', playable=True)
+            helper.add_item(title, params=params, info=info, art=item_art, content='videos', playable=True)
 
-            # Sport streams
-            if item['link']['target']['type'] == 'stream_id':
-                if item['sticker'] == 'entertainment' and helper.get_setting('ruutuplus_sticker') is False:
-                    title = item['title_time'] + ' ' + item['title'] + ' [RUUTU+]'
-                else:
-                    title = item['title_time'] + '' + item['title']
+    # Upcoming videos
+    else:
+        if item.get('upcoming'):
+            if item['upcoming'] is True:
+                # Remove episode number from title
+                title = re.sub(r'\d+\ -', '', item['title']).lstrip()
 
-                video_id = helper.r.get_page_json('stream', item['link']['target']['value'], helper.check_userrole())['components'][0]['content']['items'][0]['video_id']
+                if item['sticker'] == 'entertainment' and not ruutuplus_sticker:
+                    title = title + ' [RUUTU+] ' + helper.language(30010) + ' ' + helper.r.unix_to_datetime(item['rights'][0]['start'])
+                else:
+                    title = title + ' ' + helper.language(30010) + ' ' + helper.r.unix_to_datetime(item['rights'][0]['start'])
 
-                params = {
-                    'action': 'play',
-                    'type': 'live',
-                    'video_id': video_id,
-                    'sticker': item['sticker'] if item['sticker'] else None
-                }
+                params = {}
 
                 info = {
-                    'mediatype': 'video',
-                    'title': item['title'],
+                    'mediatype': 'episode',
+                    'title': title,
                     'plot': item.get('description')
                 }
 
+                # Get extra info for episodes
+                if series_info:
+                    info['tvshowtitle'] = series_info['tvshowtitle']
+                    info['genre'] = series_info['genre']
+
+                # Get season and episode number from description
+                if item.get('description'):
+                    pattern = re.compile(
+                        r"""(?:Kausi)(?:\s)(?P<s>\d+)(?:.*)(?:Jakso|\n)(?:\s)(?P<ep>\d+)""",
+                        re.VERBOSE)
+                    m = re.search(pattern, item['description'])
+                    if m:
+                        info['season'] = m.group('s')
+                        info['episode'] = m.group('ep')
+
                 if item.get('media'):
                     if item['media'].get('images'):
                         item_art = {
-                            'fanart': item['media']['images']['1920x1080'] if item['media']['images'].get('1920x1080') else None
+                            'fanart': helper.fanart_url(item['media']['images'].get('1920x1080'))
                         }
-
-                        if item['sticker'] == 'entertainment' and helper.get_setting('ruutuplus_sticker'):
-                            item_art['thumb'] = helper.create_ruutuplus_thumb(item['media']['images']['640x360'],
-                                                                              video_id)
+                        if item['sticker'] == 'entertainment' and ruutuplus_sticker:
+                            item_art['thumb'] = helper.create_ruutuplus_thumb(item['media']['images']['640x360'])
                         else:
                             item_art['thumb'] = item['media']['images']['640x360']
                     else:
@@ -402,74 +420,110 @@ def list_grid_content(url, ruutu_params, kodi_page):
                 else:
                     item_art = {}
 
-                helper.add_item(title, params=params, info=info, art=item_art, content='videos', playable=True)
+                helper.add_item(title, params=params, info=info, art=item_art, content='episodes', playable=False)
 
-        # Upcoming videos
-        else:
-            if item.get('upcoming'):
-                if item['upcoming'] is True:
-                    # Remove episode number from title
-                    title = re.sub(r'\d+\ -', '', item['title']).lstrip()
+def list_grid_content(url, ruutu_params, kodi_page, offset=None, limit=None, load_all=False):
+    ruutuplus_sticker = helper.settings.ruutuplus_sticker
+    # Pages after the first one carry the offset and limit they were prefetched with
+    if limit is None:
+        limit = helper.page_sizer.size()
+        offset = (int(kodi_page) - 1) * limit
+    offset, limit = int(offset), int(limit)
 
-                    if item['sticker'] == 'entertainment' and helper.get_setting('ruutuplus_sticker') is False:
-                        title = title + ' [RUUTU+] ' + helper.language(30010) + ' ' + helper.r.unix_to_datetime(item['rights'][0]['start'])
-                    else:
-                        title = title + ' ' + helper.language(30010) + ' ' + helper.r.unix_to_datetime(item['rights'][0]['start'])
+    started = time.time()
+    counters = dict(helper.r.tracer.counters)
+    items = helper.r.get_grid_json(url, ruutu_params, offset=offset, limit=limit)
+    # Only fetches that went to the network tell anything about the connection
+    if helper.r.tracer.counters.get('cache_hits', 0) == counters.get('cache_hits', 0):
+        helper.page_sizer.record(len(items['items']), time.time() - started,
+                                 helper.r.tracer.counters.get('http_bytes', 0) - counters.get('http_bytes', 0))
 
-                    params = {}
+    # Load favorites and history only when user is logged in
+    watch_state = helper.r.get_watch_state() if helper.r.credentials.account_id else None
 
-                    info = {
-                        'mediatype': 'episode',
-                        'title': title,
-                        'plot': item.get('description')
-                    }
+    # Extra info for episodes
+    if json.loads(ruutu_params).get('current_series_id'):
 
-                    # Get extra info for episodes
-                    if json.loads(ruutu_params).get('current_series_id'):
-                        info['tvshowtitle'] = tvshowtitle
-                        info['genre'] = genre
-
-                    # Get season and episode number from description
-                    if item.get('description'):
-                        pattern = re.compile(
-                            r"""(?:Kausi)(?:\s)(?P<s>\d+)(?:.*)(?:Jakso|\n)(?:\s)(?P<ep>\d+)""",
-                            re.VERBOSE)
-                        m = re.search(pattern, item['description'])
-                        if m:
-                            info['season'] = m.group('s')
-                            info['episode'] = m.group('ep')
-
-                    if item.get('media'):
-                        if item['media'].get('images'):
-                            item_art = {
-                                'fanart': item['media']['images']['1920x1080'] if item['media']['images'].get(
-                                    '1920x1080') else None
-                            }
-                            # current_series_id for ruutu+ thumb filename
-                            if item['sticker'] == 'entertainment' and helper.get_setting('ruutuplus_sticker'):
-                                item_art['thumb'] = helper.create_ruutuplus_thumb(item['media']['images']['640x360'],
-                                                                                  json.loads(ruutu_params)['current_series_id'])
-                            else:
-                                item_art['thumb'] = item['media']['images']['640x360']
-                        else:
-                            item_art = {}
-                    else:
-                        item_art = {}
+        ruutu_params2 = {
+            'current_primary_content': 'series',
+            'current_series_id': json.loads(ruutu_params)['current_series_id']
+        }
+
+        tvshow_extra_info = helper.r.get_grid_json('https://prod-component-api.nm-services.nelonenmedia.fi/api/component/26001', json.dumps(ruutu_params2))
 
-                    helper.add_item(title, params=params, info=info, art=item_art, content='episodes', playable=False)
+        series_info = {
+            'genre': tvshow_extra_info['items'][0]['subtitle'].split(', '),
+            'tvshowtitle': tvshow_extra_info['items'][0]['title']
+        }
+    else:
+        series_info = None
+
+    if load_all:
+        # Windows after the first one are fetched concurrently and added as they arrive, duplicates that
+        # shifted from one window to the next while fetching are dropped
+        seen = set()
+        windows = [items['items']]
+        if len(items['items']) >= limit:
+            windows = itertools.chain(windows, helper.r.iter_grid_windows(url, ruutu_params, offset + limit, limit))
+        for window in windows:
+            window = [item for item in window if item.get('id') is None or item['id'] not in seen]
+            seen.update(item['id'] for item in window if item.get('id') is not None)
+            add_grid_items(window, ruutuplus_sticker, watch_state, series_info)
+        helper.eod()
+        return
+
+    # Items, the next page and the show all entries
+    helper.set_total_items(len(items['items']) + 2)
+    add_grid_items(items['items'], ruutuplus_sticker, watch_state, series_info)
 
     # Next page
-    if len(items['items']) >= int(page_size):
+    next_page = None
+    if len(items['items']) >= limit:
+        next_page = {
+            'action': 'list_grid_content',
+            'url': url,
+            'ruutu_params': ruutu_params,
+            'kodi_page': int(kodi_page) + 1,
+            'offset': offset + len(items['items']),
+            'limit': helper.page_sizer.size()
+        }
+        helper.add_item(helper.language(30013), next_page)
+
         params = {
             'action': 'list_grid_content',
             'url': url,
             'ruutu_params': ruutu_params,
-            'kodi_page': int(kodi_page) + 1
+            'kodi_page': 1,
+            'offset': 0,
+            'limit': helper.page_sizer.max_size,
+            'load_all': 1
         }
-        helper.add_item(helper.language(30013), params)
+        helper.add_item(helper.language(30033), params)
 
     helper.eod()
 
+    # Kodi is already showing the listing, load the next page into the response cache meanwhile
+    if next_page:
+        try:
+            helper.r.get_grid_json(url, ruutu_params, offset=next_page['offset'], limit=next_page['limit'])
+        except Exception as error:
+            helper.log('Prefetching the next page failed: %s' % error)
+
+def add_grid_items(items, ruutuplus_sticker, watch_state, series_info):
+    # Composite Ruutu+ thumbs in parallel before building the listing
+    if ruutuplus_sticker:
+        helper.prepare_ruutuplus_thumbs([item['media']['images']['640x360'] for item in items
+                                         if item['sticker'] == 'entertainment' and item.get('media')
+                                         and item['media'].get('images') and item['media']['images'].get('640x360')])
+
+    # Resolve video ids of live channels and sport streams in one go
+    live_targets = [(item['link']['target']['type'], item['link']['target']['value']) for item in items
+                    if item['link'] and item['link']['target']['type'] in ('channel_id', 'stream_id')]
+    live_video_ids = helper.r.resolve_video_ids(live_targets, helper.check_userrole())
+
+    for item in items:
+        add_grid_item(item, ruutuplus_sticker, watch_state, live_video_ids, series_info)
+
 def list_seasons(series_id):
     ruutu_params = {
         'app': 'ruutu',
@@ -499,13 +553,49 @@ def list_seasons(series_id):
     helper.eod()
 
 def search():
+    terms = helper.search_history.terms()
+    if not terms:
+        return new_search()
+
+    helper.add_item(helper.language(30036), params={'action': 'new_search'})
+    for term in terms:
+        menu = [(helper.language(30037), 'RunPlugin(plugin://plugin.video.ruutu/?' +
+                 urllib.urlencode({'action': 'remove_search', 'search_term': term}) + ')')]
+        helper.add_item(term, params={'action': 'search_term', 'search_term': term}, menu=menu)
+
+    helper.eod()
+
+def new_search():
     search_term = helper.get_user_input(helper.language(30007))
     if search_term:
-        list_search_result_grids(search_term=search_term)
+        search_results(search_term)
     else:
         helper.log('No search query provided.')
         return False
 
+def search_results(search_term):
+    # Equal searches share the cached component 336 response and the history entry
+    search_term = normalize_term(search_term)
+    helper.search_history.add(search_term)
+
+    # Items already seen in listings are found locally, Ruutu is asked when the catalog knows nothing
+    items = helper.r.catalog.search(search_term)
+    if items:
+        list_catalog_search_results(search_term, items)
+    else:
+        list_search_result_grids(search_term=search_term)
+
+# Hidden menu, opened from the addon settings
+def diagnostics():
+    for name, key, count, p50, p95 in helper.r.tracer.statistics():
+        if name.startswith('invocation.'):
+            title = '%s %s: p50 %s, p95 %s (%s)' % (name, key, p50, p95, count)
+        else:
+            title = '%s %s: p50 %.0f ms, p95 %.0f ms (%s)' % (name, key, p50, p95, count)
+        helper.add_item(title, params={'action': 'diagnostics'})
+
+    helper.eod()
+
 def router(paramstring):
     """
     Router function that calls other functions
@@ -516,17 +606,22 @@ def router(paramstring):
     # Parse a URL-encoded paramstring to the dictionary of
     # {<parameter>: <value>} elements
     params = dict(parse_qsl(paramstring))
+    helper.r.tracer.action = params.get('action') or params.get('setting') or 'root'
     # Check the parameters passed to the plugin
     if 'setting' in params:
         if params['setting'] == 'reset_credentials':
             helper.reset_credentials()
+        elif params['setting'] == 'clear_cache':
+            helper.r.cache.clear()
     elif 'action' in params:
         if params['action'] == 'list_grids':
             list_grids(page_id=params['page_id'], userroles=params['userroles'])
         elif params['action'] == 'list_children_pages':
             list_children_pages(children=params['children'])
         elif params['action'] == 'list_grid_content':
-            list_grid_content(url=params['url'], ruutu_params=params['ruutu_params'], kodi_page=params['kodi_page'])
+            list_grid_content(url=params['url'], ruutu_params=params['ruutu_params'], kodi_page=params['kodi_page'],
+                              offset=params.get('offset'), limit=params.get('limit'),
+                              load_all=params.get('load_all') == '1')
         elif params['action'] == 'list_seasons':
             list_seasons(series_id=params['series_id'])
         elif params['action'] == 'play':
@@ -534,14 +629,25 @@ def router(paramstring):
             helper.play_item(video_id=params['video_id'], type=params['type'], sticker=params['sticker'])
         elif params['action'] == 'search':
             search()
+        elif params['action'] == 'new_search':
+            new_search()
+        elif params['action'] == 'search_term':
+            search_results(params['search_term'])
+        elif params['action'] == 'remove_search':
+            helper.search_history.remove(params['search_term'])
+            xbmc.executebuiltin('Container.Refresh')
+        elif params['action'] == 'search_remote':
+            list_search_result_grids(search_term=params['search_term'])
+        elif params['action'] == 'diagnostics':
+            diagnostics()
         elif params['action'] == 'add_favorite':
-            helper.r.add_favorite(series_id=params['series_id'], gatling_token=params['gatling_token'])
+            helper.set_favorite(series_id=params['series_id'], favorite=True)
         elif params['action'] == 'remove_favorite':
-            helper.r.remove_favorite(series_id=params['series_id'], gatling_token=params['gatling_token'])
+            helper.set_favorite(series_id=params['series_id'], favorite=False)
     else:
         if helper.check_for_credentials():
             try:
-                helper.login_process()
+                helper.ensure_session()
             except helper.r.RuutuError as error:
                 helper.dialog('ok', helper.language(30006), error.value)
             list_pages()
@@ -552,4 +658,7 @@ def router(paramstring):
 if __name__ == '__main__':
     # Call the router function and pass the plugin call parameters to it.
     # We use string slicing to trim the leading '?' from the plugin call paramstring
-    router(sys.argv[2][1:])
+    try:
+        router(sys.argv[2][1:])
+    finally:
+        helper.r.close()
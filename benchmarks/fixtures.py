@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Responses of the Ruutu APIs replayed by the benchmark server
+
+Bodies have the structure of recorded navigation, page, component, gatling storage, media-xml and MPD responses.
+The content is generated from fixed ids so every run transfers the same bytes, grids are sliced by offset and
+limit like the real component API.
+"""
+import json
+import base64
+import urlparse
+from StringIO import StringIO
+
+COMPONENT_API = 'https://prod-component-api.nm-services.nelonenmedia.fi/api/component/'
+IMAGE_URL = 'https://images.nelonenmedia.fi/bench/%s/%s.jpg'
+
+SERIES_ID = 5000
+# Grid components: (id, label, item kind, total items)
+GRIDS = [
+    (1001, u'Uusimmat jaksot', 'video_id', 600),
+    (1002, u'Suositut sarjat', 'series_id', 120),
+    (1003, u'Kanavat', 'channel_id', 5),
+    (1004, u'Elokuvat', 'video_id', 200),
+    (1005, u'Dokumentit', 'series_id', 60)
+]
+UNFINISHED_GRID = 2001
+FAVORITES_GRID = 2002
+
+# Manifest of a DRM protected video, its PlayReady entry is in every period after the Widevine one
+MPD_PERIODS = 40
+SEGMENTS_PER_PERIOD = 60
+LICENSE_URL = 'https://license.nelonenmedia.fi/playready/rightsmanager.asmx?bench=1'
+
+# A JWT that expires in 2100, stream descriptors stay cacheable
+PLAY_TOKEN = '.'.join(base64.urlsafe_b64encode(part).rstrip('=') for part in
+                      ('{"alg":"HS256","typ":"JWT"}', '{"exp":4102444800}', 'signature'))
+
+
+def dumps(data):
+    return json.dumps(data, sort_keys=True)
+
+
+def is_premium(item_id):
+    return int(item_id) % 3 == 0
+
+
+def grid_item(kind, item_id):
+    images = {
+        '640x360': IMAGE_URL % (item_id, '640x360'),
+        '1920x1080': IMAGE_URL % (item_id, '1920x1080')
+    }
+    item = {
+        'id': item_id,
+        'sticker': 'entertainment' if is_premium(item_id) else None,
+        'link': {'target': {'type': kind, 'value': item_id}},
+        'media': {'images': images}
+    }
+    if kind == 'video_id':
+        item.update({
+            'title': u'%s - Jakso %s (7)' % (item_id % 20 + 1, item_id),
+            'description': u'Kausi %s, Jakso %s. Jakson kuvaus, jossa kerrotaan mitä tapahtuu ja kuka on mukana.' % (
+                item_id % 5 + 1, item_id % 20 + 1),
+            'timebar': {'end': 2640},
+            'rights': [{'start': 1600000000 + item_id}],
+            'tv_ratings': {'agelimit': 7}
+        })
+    elif kind == 'series_id':
+        item.update({
+            'title': u'Sarja %s' % item_id,
+            'subtitle': u'Draama, Jännitys',
+            'description': u'Sarjan %s kuvaus.' % item_id
+        })
+    else:
+        item.update({
+            'title': u'Ohjelma %s' % item_id,
+            'title_detail': u'Kanava %s' % item_id,
+            'title_time': u'20.00'
+        })
+    return item
+
+
+def grid_component(component_id, label, params):
+    return {
+        'id': component_id,
+        'label': {'text': label},
+        'content': {'query': {'url': COMPONENT_API + str(component_id), 'params': params}}
+    }
+
+
+class RuutuFixtures(object):
+    """Maps a request to (status, content type, body)."""
+
+    def __init__(self):
+        self.grid_items = {}
+        for component_id, label, kind, total in GRIDS:
+            self.grid_items[component_id] = [grid_item(kind, component_id * 1000 + index) for index in range(total)]
+        self.history = [{'video': 1001000 + index, 'unfinished': index % 2 == 0, 'watched': 600 if index % 2 else 120}
+                        for index in range(0, 60, 3)]
+        self.favorites = [{'item': 1002000 + index, 'type': 'series'} for index in range(0, 30, 3)]
+        self._image = None
+        self._mpd = None
+
+    def respond(self, method, host, path, query, body):
+        params = dict(urlparse.parse_qsl(query))
+        if host == 'prod-component-api.nm-services.nelonenmedia.fi':
+            if path.startswith('/api/navigation'):
+                return self.json(self.navigation())
+            if path.startswith('/api/page/'):
+                return self.json(self.page(int(path.rsplit('/', 1)[1])))
+            if path.startswith('/api/channel/') or path.startswith('/api/stream/'):
+                return self.json(self.live(int(path.rsplit('/', 1)[1])))
+            if path.startswith('/api/component/'):
+                return self.json(self.component(int(path.rsplit('/', 1)[1]), params))
+        elif host == 'gatling.nelonenmedia.fi':
+            if path.startswith('/storage/'):
+                return self.storage(method, path[len('/storage/'):])
+            if path == '/media-xml-cache':
+                return 200, 'text/xml', self.media_xml(int(params['id']))
+            if path == '/auth/access/v2':
+                return 200, 'text/plain', 'https://vod.nelonenmedia.fi/bench/hls/index.m3u8?exp=4102444800'
+            if path == '/drm/check':
+                return self.json({'empDrmKey': {'playToken': PLAY_TOKEN,
+                                                'mediaLocator': '//vod.nelonenmedia.fi/bench/%s/manifest.mpd' %
+                                                                params['nid']}})
+            if path == '/recommend':
+                return self.json({'next_in_sequence': {'nid': int(params['id']) + 1}})
+        elif host == 'dynamic-gatling.nelonenmedia.fi' and path.startswith('/cos/videos'):
+            return self.json(self.video(int(params['id'])))
+        elif host == 'vod.nelonenmedia.fi' and path.endswith('.mpd'):
+            return 200, 'application/dash+xml', self.mpd()
+        elif host == 'images.nelonenmedia.fi':
+            return 200, 'image/jpeg', self.image()
+        return 404, 'text/plain', 'Not found'
+
+    def json(self, data):
+        return 200, 'application/json', dumps(data)
+
+    def navigation(self):
+        children = [{'label': {'text': u'Kategoria %s' % page_id}, 'action': {'page_id': page_id}}
+                    for page_id in range(110, 118)]
+        children.append({'label': {'text': u'Väliotsikko'}})
+        return {'main': [
+            {'title': u'Etusivu', 'action': {'page_id': 200}},
+            {'title': u'Sarjat', 'action': {'page_id': 100}},
+            {'title': u'Elokuvat', 'action': {'page_id': 101}},
+            {'title': u'TV', 'children': children},
+            {'title': u'Urheilu', 'action': {'page_id': 102}}
+        ]}
+
+    def page(self, page_id):
+        if page_id == 2000:
+            components = [
+                grid_component(UNFINISHED_GRID, u'Jatka katsomista', {'user_unfinished_videos': ''}),
+                grid_component(FAVORITES_GRID, u'Omat suosikit', {'user_favorite_series': ''})
+            ]
+        else:
+            components = [grid_component(component_id, label, {'page': page_id}) for component_id, label, kind, total
+                          in GRIDS]
+            # Episodes of one series, listing them fetches the series info too
+            components[0]['content']['query']['params']['current_series_id'] = SERIES_ID
+            # Hidden grids and components without a label are skipped by the addon
+            components.append(grid_component(545, u'Urheilulähetykset', {}))
+            components.append({'id': 9999, 'label': {}, 'content': {'query': {'url': None, 'params': {}}}})
+        return {'id': page_id, 'components': components}
+
+    def component(self, component_id, params):
+        if component_id == 26001:
+            return {'items': [{'title': u'Sarja %s' % SERIES_ID, 'subtitle': u'Draama, Jännitys'}]}
+        if component_id == UNFINISHED_GRID:
+            items = [grid_item('video_id', int(x)) for x in params.get('user_unfinished_videos', '').split(',') if x]
+        elif component_id == FAVORITES_GRID:
+            items = [grid_item('series_id', int(x)) for x in params.get('user_favorite_series', '').split(',') if x]
+        else:
+            items = self.grid_items.get(component_id, [])
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 25)
+        return {'id': component_id, 'items': items[offset:offset + limit]}
+
+    def live(self, target_id):
+        return {'components': [{'content': {'items': [{'video_id': target_id + 7000000,
+                                                       'content': {'items': [{'video_id': target_id + 7000000}]}}]}}]}
+
+    def storage(self, method, endpoint):
+        if method != 'GET':
+            return self.json({})
+        if endpoint.startswith('history'):
+            return self.json(self.history)
+        if endpoint.startswith('favorite'):
+            return self.json(self.favorites)
+        return self.json({})
+
+    def video(self, video_id):
+        return {'videos': [{
+            'id': video_id,
+            'episode_name': u'Jakso %s' % video_id,
+            'name': u'Video %s' % video_id,
+            'series': u'Sarja %s' % SERIES_ID,
+            'season': 1,
+            'episode': video_id % 20 + 1,
+            'description': u'Jakson kuvaus.',
+            'runtime': 2640,
+            'created': '2020-01-01',
+            'premium': 1 if is_premium(video_id) else 0,
+            'media': {'images': [{'1920x1080': IMAGE_URL % (video_id, '1920x1080')}]}
+        }]}
+
+    def media_xml(self, video_id):
+        if is_premium(video_id):
+            drm = '<DRM check_url="https://gatling.nelonenmedia.fi/drm/check" asset_id="asset-%s"/>' % video_id
+        else:
+            drm = '<DRM/>'
+        return ('<?xml version="1.0" encoding="UTF-8"?><Playerdata><Clip>%s<AppleMediaFiles>'
+                '<AppleMediaFile>https://vod.nelonenmedia.fi/bench/%s/index.m3u8</AppleMediaFile>'
+                '</AppleMediaFiles></Clip></Playerdata>' % (drm, video_id))
+
+    def mpd(self):
+        if self._mpd is None:
+            segments = ''.join('<S t="%s" d="96000"/>' % (index * 96000) for index in range(SEGMENTS_PER_PERIOD))
+            parts = ['<?xml version="1.0" encoding="UTF-8"?>'
+                     '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" xmlns:cenc="urn:mpeg:cenc:2013" '
+                     'xmlns:ms="urn:microsoft:playready" type="static" mediaPresentationDuration="PT44M">']
+            for period in range(MPD_PERIODS):
+                parts.append('<Period id="p%s">' % period)
+                for content_type in ('video', 'audio'):
+                    parts.append('<AdaptationSet contentType="%s">' % content_type)
+                    parts.append('<ContentProtection schemeIdUri="urn:mpeg:dash:mp4protection:2011" value="cenc"/>'
+                                 '<ContentProtection schemeIdUri="urn:uuid:edef8ba9-79d6-4ace-a3c8-27dcd51d21ed">'
+                                 '<cenc:pssh>AAAAW3Bzc2gAAAAA7e+LqXnWSs6jyCfc1R0h7QAAADsIARIQ</cenc:pssh>'
+                                 '</ContentProtection>'
+                                 '<ContentProtection schemeIdUri="urn:uuid:9a04f079-9840-4286-ab92-e65be0885f95">'
+                                 '<ms:laurl licenseUrl="%s"/></ContentProtection>' % LICENSE_URL.replace('&', '&amp;'))
+                    for bandwidth in (500000, 1500000, 3000000, 6000000):
+                        parts.append('<Representation id="%s-%s" bandwidth="%s"><SegmentTemplate timescale="48000">'
+                                     '<SegmentTimeline>%s</SegmentTimeline></SegmentTemplate></Representation>' %
+                                     (content_type, bandwidth, bandwidth, segments))
+                    parts.append('</AdaptationSet>')
+                parts.append('</Period>')
+            parts.append('</MPD>')
+            self._mpd = ''.join(parts)
+        return self._mpd
+
+    def image(self):
+        if self._image is None:
+            from PIL import Image
+            output = StringIO()
+            Image.new('RGB', (640, 360), (40, 80, 120)).save(output, 'JPEG', quality=85)
+            self._image = output.getvalue()
+        return self._image
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Run one plugin invocation against the replay server and print its measurements as JSON
+
+Usage: invoke.py <replay server URL> <plugin paramstring>
+
+The xbmcaddon stub reads the profile folder from BENCH_PROFILE and settings from BENCH_SETTINGS. Wall time ends
+when the router returns, background work started by the invocation is waited for so that its requests are
+always counted.
+"""
+import os
+import sys
+import json
+import time
+import runpy
+import threading
+import traceback
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+ADDON_PATH = os.path.dirname(BENCHMARKS_PATH)
+sys.path[0:0] = [os.path.join(BENCHMARKS_PATH, 'stubs'), ADDON_PATH, BENCHMARKS_PATH]
+
+# Seconds to wait for each thread left running by the invocation
+BACKGROUND_WAIT = 10
+
+
+def main(server_url, paramstring):
+    from replay import route_requests
+    adapter = route_requests(server_url)
+
+    import xbmcplugin
+    from resources.lib.tracing import Tracer
+
+    sys.argv = ['plugin://plugin.video.ruutu/', '1', '?' + paramstring]
+    error = None
+    started = time.time()
+    try:
+        runpy.run_path(os.path.join(ADDON_PATH, 'addon.py'), run_name='__main__')
+    except Exception as exc:
+        traceback.print_exc()
+        error = '%s: %s' % (type(exc).__name__, exc)
+    wall_ms = (time.time() - started) * 1000
+
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+            thread.join(BACKGROUND_WAIT)
+
+    result = adapter.stats()
+    result.update({
+        'wall_ms': round(wall_ms, 1),
+        'peak_kb': Tracer().peak_memory(),
+        'items': len(xbmcplugin.directory['items']),
+        'ended': xbmcplugin.directory['ended'],
+        'resolved': xbmcplugin.directory['resolved'] is not None,
+        'error': error
+    })
+    print json.dumps(result)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2])
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP server standing in for the Ruutu APIs and the requests adapter that sends traffic to it
+
+Faults can be injected per path to test the client against slow and failing APIs.
+"""
+import sys
+import time
+import socket
+import threading
+import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+    """Answers /<host>/<path> with the fixture of https://<host>/<path>."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, fixtures, host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), ReplayHandler)
+        self.fixtures = fixtures
+        self.thread = None
+        self.faults = []
+        self.faults_lock = threading.Lock()
+
+    def inject(self, prefix, status=None, delay=0, times=None):
+        """Answer requests to https://<prefix>... with status after waiting delay seconds.
+
+        Without status the fixture is served after the delay. times limits how many requests get the fault.
+        """
+        with self.faults_lock:
+            self.faults.append({'prefix': prefix, 'status': status, 'delay': delay, 'times': times})
+
+    def clear_faults(self):
+        with self.faults_lock:
+            self.faults = []
+
+    def fault_for(self, path):
+        """The fault of the first matching rule, used up rules are removed."""
+        with self.faults_lock:
+            for fault in self.faults:
+                if path.startswith(fault['prefix']):
+                    if fault['times'] is not None:
+                        fault['times'] -= 1
+                        if fault['times'] <= 0:
+                            self.faults.remove(fault)
+                    return fault
+        return None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%s' % (host, port)
+
+    def handle_error(self, request, client_address):
+        # Clients closing connections early is expected, anything else is a bug in the fixtures
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self, method):
+        host, _, path = self.path.lstrip('/').partition('/')
+        parsed = urlparse.urlparse('/' + path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+
+        fault = self.server.fault_for(host + parsed.path)
+        if fault and fault['delay']:
+            time.sleep(fault['delay'])
+        if fault and fault['status']:
+            status, content_type, content = fault['status'], 'text/html', '<html>Injected error</html>'
+        else:
+            status, content_type, content = self.server.fixtures.respond(method, host, parsed.path, parsed.query,
+                                                                         body)
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        try:
+            self.wfile.write(content)
+        except socket.error:
+            # The client stopped reading, the manifest reader does that once it has the license URL
+            pass
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+    def do_PUT(self):
+        self.respond('PUT')
+
+    def do_DELETE(self):
+        self.respond('DELETE')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ReplayAdapter(HTTPAdapter):
+    """Sends https://<host>/<path> to <server_url>/<host>/<path>, counts requests and the body bytes read."""
+
+    def __init__(self, server_url):
+        HTTPAdapter.__init__(self)
+        self.server_url = server_url
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.endpoints = {}
+
+    def stats(self):
+        with self.lock:
+            return {'http_requests': self.requests, 'http_bytes': self.bytes, 'endpoints': dict(self.endpoints)}
+
+    def count(self, requests=0, size=0, endpoint=None):
+        with self.lock:
+            self.requests += requests
+            self.bytes += size
+            if endpoint:
+                self.endpoints[endpoint] = self.endpoints.get(endpoint, 0) + 1
+
+    def send(self, request, **kwargs):
+        parsed = urlparse.urlparse(request.url)
+        self.count(requests=1, endpoint='%s %s%s' % (request.method, parsed.netloc, parsed.path))
+        request.url = '%s/%s%s' % (self.server_url, parsed.netloc, request.path_url)
+        response = HTTPAdapter.send(self, request, **kwargs)
+
+        # Only what the client reads counts, a streamed manifest is closed after the first chunks
+        read = response.raw.read
+
+        def counting_read(*args, **kwargs):
+            data = read(*args, **kwargs)
+            self.count(size=len(data or ''))
+            return data
+
+        response.raw.read = counting_read
+        return response
+
+
+def route_requests(server_url):
+    """Make every requests.Session of the process talk to the replay server instead of the internet.
+
+    Return the adapter, its stats() tell what the process transferred.
+    """
+    adapter = ReplayAdapter(server_url)
+    get_adapter = requests.Session.get_adapter
+
+    def replay_adapter(session, url):
+        if url.startswith(server_url):
+            return get_adapter(session, url)
+        return adapter
+
+    requests.Session.get_adapter = replay_adapter
+    return adapter
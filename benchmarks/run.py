@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite and regression gate of the plugin
+
+Every scenario is one plugin invocation in its own process with a fresh profile folder, so the response cache
+starts cold and peak memory is the invocation's own. Kodi is replaced by the modules in stubs/ and the Ruutu
+APIs by a local server replaying fixtures.py. Reported per scenario: wall time, HTTP requests, bytes transferred
+and peak memory.
+
+    python benchmarks/run.py                    # compare with baseline.json, exit 1 on a regression
+    python benchmarks/run.py --update-baseline  # store the current numbers as the baseline
+
+Wall times depend on the machine, refresh the baseline on the machine that runs the gate or pass --no-time.
+"""
+import os
+import sys
+import json
+import shutil
+import urllib
+import argparse
+import tempfile
+import subprocess
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_PATH)
+
+from fixtures import RuutuFixtures, COMPONENT_API, SERIES_ID
+from replay import ReplayServer
+
+BASELINE_FILE = os.path.join(BENCHMARKS_PATH, 'baseline.json')
+
+# Allowed growth over the baseline before a scenario counts as a regression
+BYTES_TOLERANCE = 1.05
+MEMORY_TOLERANCE = 1.2
+TIME_TOLERANCE = 1.5
+TIME_SLACK_MS = 50
+
+CREDENTIALS = {
+    'accountId': '1000001',
+    'token': 'bench-gatling-token',
+    'username': 'bench@example.com',
+    'session_expires': 4102444800,
+    'service': {'ruutuRole': 'ruutu_plus_viihde'}
+}
+LOGIN_SETTINGS = {'username': CREDENTIALS['username'], 'password': 'bench'}
+
+# No addon service in the benchmark, everything is fetched by the plugin itself
+BASE_SETTINGS = {'use_service': False, 'image_proxy': False, 'catalog_crawl': False}
+
+FREE_VIDEO_ID = 1001002
+PREMIUM_VIDEO_ID = 1001001
+
+
+def scenarios():
+    """Return [(name, paramstring, logged_in, settings)]."""
+    result = []
+    for logged_in in (False, True):
+        user = 'logged_in' if logged_in else 'anonymous'
+        userroles = CREDENTIALS['service']['ruutuRole'] if logged_in else 'anonymous'
+        result.append(('list_pages/%s' % user, '', logged_in, {}))
+        result.append(('list_grids/%s' % user, urllib.urlencode({
+            'action': 'list_grids', 'page_id': 100, 'userroles': userroles}), logged_in, {}))
+
+    grid_params = json.dumps({'current_series_id': SERIES_ID, 'page': 100})
+    for size in (25, 100, 500):
+        for logged_in in (False, True):
+            for sticker in (False, True):
+                name = 'list_grid_content/%s/%s/sticker_%s' % (size, 'logged_in' if logged_in else 'anonymous',
+                                                               'on' if sticker else 'off')
+                result.append((name, urllib.urlencode({
+                    'action': 'list_grid_content', 'url': COMPONENT_API + '1001', 'ruutu_params': grid_params,
+                    'kodi_page': 1, 'offset': 0, 'limit': size}), logged_in, {'ruutuplus_sticker': sticker}))
+
+    result.append(('play_item/anonymous', urllib.urlencode({
+        'action': 'play', 'type': 'video', 'video_id': FREE_VIDEO_ID, 'sticker': None}), False, {}))
+    result.append(('play_item/logged_in', urllib.urlencode({
+        'action': 'play', 'type': 'video', 'video_id': PREMIUM_VIDEO_ID, 'sticker': 'entertainment'}), True, {}))
+    return result
+
+
+def invoke(server, paramstring, logged_in, settings):
+    """Run one invocation with a fresh profile. Return its measurements."""
+    profile = tempfile.mkdtemp(prefix='ruutu-bench-')
+    try:
+        all_settings = dict(BASE_SETTINGS)
+        if logged_in:
+            all_settings.update(LOGIN_SETTINGS)
+            with open(os.path.join(profile, 'credentials'), 'w') as fh_credentials:
+                fh_credentials.write(json.dumps(CREDENTIALS))
+        all_settings.update(settings)
+
+        env = dict(os.environ, BENCH_PROFILE=profile, BENCH_SETTINGS=json.dumps(all_settings))
+        process = subprocess.Popen([sys.executable, os.path.join(BENCHMARKS_PATH, 'invoke.py'), server.url,
+                                    paramstring], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+    finally:
+        shutil.rmtree(profile, ignore_errors=True)
+
+    try:
+        result = json.loads(stdout.strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        result = {'error': 'Invocation crashed: %s' % stderr.strip()[-500:], 'http_requests': 0, 'http_bytes': 0}
+    return result
+
+
+def measure(server, scenario, repeat):
+    """Best wall time and worst peak memory of repeat runs, requests and bytes of the first run."""
+    name, paramstring, logged_in, settings = scenario
+    runs = [invoke(server, paramstring, logged_in, settings) for _ in range(repeat)]
+    first = runs[0]
+    errors = [run['error'] for run in runs if run.get('error')]
+    return {
+        'wall_ms': min(run.get('wall_ms', 0) for run in runs),
+        'peak_kb': max(run.get('peak_kb') or 0 for run in runs),
+        'http_requests': first['http_requests'],
+        'http_bytes': first['http_bytes'],
+        'items': first.get('items'),
+        'error': errors[0] if errors else None
+    }
+
+
+def regressions(result, baseline, check_time):
+    """Reasons why result is worse than baseline."""
+    reasons = []
+    if result['error']:
+        reasons.append(result['error'])
+    if not baseline:
+        return reasons
+    if result['http_requests'] > baseline['http_requests']:
+        reasons.append('requests %s > %s' % (result['http_requests'], baseline['http_requests']))
+    if result['http_bytes'] > baseline['http_bytes'] * BYTES_TOLERANCE:
+        reasons.append('bytes %s > %s' % (result['http_bytes'], baseline['http_bytes']))
+    if result['peak_kb'] > baseline['peak_kb'] * MEMORY_TOLERANCE:
+        reasons.append('peak memory %s kB > %s kB' % (result['peak_kb'], baseline['peak_kb']))
+    if check_time and result['wall_ms'] > baseline['wall_ms'] * TIME_TOLERANCE + TIME_SLACK_MS:
+        reasons.append('wall time %.0f ms > %.0f ms' % (result['wall_ms'], baseline['wall_ms']))
+    return reasons
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark plugin invocations against replayed Ruutu APIs.')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per scenario, the best wall time counts')
+    parser.add_argument('--filter', default='', help='only scenarios whose name contains this')
+    parser.add_argument('--update-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--no-time', action='store_true', help="don't compare wall times with the baseline")
+    args = parser.parse_args()
+
+    try:
+        with open(BASELINE_FILE, 'r') as fh_baseline:
+            baseline = json.loads(fh_baseline.read())
+    except (IOError, ValueError):
+        baseline = {}
+
+    server = ReplayServer(RuutuFixtures())
+    server.start()
+    results = {}
+    failed = False
+    print '%-44s %6s %9s %8s %10s %9s  %s' % ('scenario', 'items', 'wall ms', 'requests', 'kB', 'peak MB', 'status')
+    try:
+        for scenario in scenarios():
+            name = scenario[0]
+            if args.filter not in name:
+                continue
+            result = measure(server, scenario, max(1, args.repeat))
+            results[name] = result
+            reasons = regressions(result, baseline.get(name), not args.no_time)
+            failed = failed or bool(reasons)
+            status = '; '.join(reasons) if reasons else ('ok' if name in baseline else 'new')
+            print '%-44s %6s %9.0f %8s %10.1f %9.1f  %s' % (name, result['items'], result['wall_ms'],
+                                                            result['http_requests'], result['http_bytes'] / 1024.0,
+                                                            result['peak_kb'] / 1024.0, status)
+    finally:
+        server.stop()
+
+    if args.update_baseline:
+        if any(result['error'] for result in results.values()):
+            print 'Not updating the baseline, some scenarios failed'
+            return 1
+        baseline.update((name, dict((key, result[key]) for key in ('wall_ms', 'peak_kb', 'http_requests',
+                                                                    'http_bytes')))
+                        for name, result in results.items())
+        with open(BASELINE_FILE, 'w') as fh_baseline:
+            fh_baseline.write(json.dumps(baseline, indent=2, sort_keys=True, separators=(',', ': ')) + '\n')
+        print 'Baseline updated'
+        return 0
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
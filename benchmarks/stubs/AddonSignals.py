@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-in for the AddonSignals module, sent signals are kept in signals
+"""
+
+signals = []
+slots = {}
+
+
+def registerSlot(signaler_id, signal, callback):
+    slots[(signaler_id, signal)] = callback
+
+
+def sendSignal(signal, data=None, source_id=None):
+    signals.append((signal, data, source_id))
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-in for inputstreamhelper, inputstream.adaptive is always there
+"""
+
+
+class Helper(object):
+    def __init__(self, protocol, drm=None):
+        self.protocol = protocol
+        self.drm = drm
+
+    def check_inputstream(self):
+        return True
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-in for Kodi's xbmc module
+
+Playback is simulated: a resolved item starts playing and every sleep() moves the position forward
+PLAYBACK_SPEED times the requested time while sleeping only a millisecond, until the video ends. The position
+stays at the start until UpNext has got its data, in Kodi there are minutes for that.
+"""
+import os
+import sys
+import time
+
+import AddonSignals
+
+LOGDEBUG, LOGINFO, LOGNOTICE, LOGWARNING, LOGERROR = 0, 1, 2, 3, 4
+
+PLAYBACK_SPEED = 60
+# Longest wait for the UpNext data in seconds
+UPNEXT_WAIT = 5
+
+abortRequested = False
+
+# Log lines at or above this level go to stderr
+LOG_LEVEL = int(os.environ.get('BENCH_LOG_LEVEL', LOGERROR))
+
+_players = []
+_playback = {'playing': False, 'started': False, 'position': 0.0, 'total': 0.0}
+
+
+def log(msg, level=LOGDEBUG):
+    if level >= LOG_LEVEL:
+        sys.stderr.write('%s\n' % msg)
+
+
+def translatePath(path):
+    return path
+
+
+def executebuiltin(function, wait=False):
+    pass
+
+
+def start_playback(total):
+    """Called by xbmcplugin.setResolvedUrl."""
+    _playback.update(playing=True, started=False, position=0.0, total=float(total), started_at=time.time())
+
+
+def sleep(milliseconds):
+    time.sleep(0.001)
+    if not _playback['playing']:
+        return
+    if not _playback['started']:
+        _playback['started'] = True
+        for player in list(_players):
+            player.onPlayBackStarted()
+        return
+    if not any(signal[0] == 'upnext_data' for signal in AddonSignals.signals) \
+            and time.time() - _playback['started_at'] < UPNEXT_WAIT:
+        return
+    _playback['position'] += milliseconds / 1000.0 * PLAYBACK_SPEED
+    if _playback['position'] >= _playback['total']:
+        _playback['playing'] = False
+        for player in list(_players):
+            player.onPlayBackEnded()
+
+
+class Player(object):
+    def __new__(cls, *args, **kwargs):
+        player = object.__new__(cls)
+        _players.append(player)
+        return player
+
+    def isPlayingVideo(self):
+        return _playback['playing'] and _playback['started']
+
+    def getTime(self):
+        return _playback['position']
+
+    def getTotalTime(self):
+        return _playback['total']
+
+    def onPlayBackStarted(self):
+        pass
+
+    def onPlayBackEnded(self):
+        pass
+
+    def onPlayBackStopped(self):
+        pass
+
+    def onPlayBackError(self):
+        pass
+
+
+class Monitor(object):
+    def abortRequested(self):
+        return abortRequested
+
+    def waitForAbort(self, timeout=None):
+        return abortRequested
+
+
+class Keyboard(object):
+    def __init__(self, default='', heading='', hidden=False):
+        self.text = os.environ.get('BENCH_KEYBOARD', default)
+
+    def doModal(self):
+        pass
+
+    def isConfirmed(self):
+        return bool(self.text)
+
+    def getText(self):
+        return self.text
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-in for Kodi's xbmcaddon module
+
+Settings are the defaults of settings.xml with the JSON object of BENCH_SETTINGS on top, the profile folder
+is BENCH_PROFILE.
+"""
+import os
+import re
+import json
+import xml.etree.ElementTree as ET
+
+ADDON_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_settings = None
+
+
+def _load_settings():
+    settings = {}
+    for setting in ET.parse(os.path.join(ADDON_PATH, 'resources', 'settings.xml')).iter('setting'):
+        if setting.get('id') and setting.get('type') != 'action':
+            settings[setting.get('id')] = setting.get('default') or ''
+    for key, value in json.loads(os.environ.get('BENCH_SETTINGS') or '{}').items():
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        settings[key] = str(value)
+    return settings
+
+
+class Addon(object):
+    def __init__(self, id=None):
+        global _settings
+        if _settings is None:
+            _settings = _load_settings()
+        with open(os.path.join(ADDON_PATH, 'addon.xml'), 'r') as fh_addon:
+            self.version = re.search(r'<addon[^>]+version="([^"]+)"', fh_addon.read()).group(1)
+
+    def getAddonInfo(self, key):
+        return {
+            'id': 'plugin.video.ruutu',
+            'name': 'Ruutu',
+            'version': self.version,
+            'path': ADDON_PATH,
+            'profile': os.environ.get('BENCH_PROFILE', os.path.join(ADDON_PATH, 'benchmarks', 'profile')),
+            'icon': os.path.join(ADDON_PATH, 'resources', 'icon.png'),
+            'fanart': os.path.join(ADDON_PATH, 'resources', 'fanart.jpg')
+        }.get(key, '')
+
+    def getSetting(self, key):
+        return _settings.get(key, '')
+
+    def setSetting(self, key, value):
+        _settings[key] = value
+
+    def getLocalizedString(self, string_id):
+        return u'$LOCALIZE[%s]' % string_id
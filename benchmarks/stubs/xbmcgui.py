@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-in for Kodi's xbmcgui module
+"""
+
+_properties = {}
+
+
+class ListItem(object):
+    def __init__(self, label='', label2='', path=''):
+        self.label = label
+        self.path = path
+        self.properties = {}
+        self.art = {}
+        self.info = {}
+        self.context_menu = []
+
+    def setProperty(self, key, value):
+        self.properties[key] = value
+
+    def getProperty(self, key):
+        return self.properties.get(key, '')
+
+    def setArt(self, art):
+        self.art.update(art)
+
+    def setInfo(self, type, info):
+        self.info.update(info)
+
+    def addContextMenuItems(self, items):
+        self.context_menu.extend(items)
+
+
+class Window(object):
+    def __init__(self, window_id):
+        self.properties = _properties.setdefault(window_id, {})
+
+    def getProperty(self, key):
+        return self.properties.get(key, '')
+
+    def setProperty(self, key, value):
+        self.properties[key] = value
+
+    def clearProperty(self, key):
+        self.properties.pop(key, None)
+
+
+class Dialog(object):
+    def ok(self, heading, message):
+        return True
+
+    def yesno(self, heading, message, nolabel=None, yeslabel=None):
+        return False
+
+    def select(self, heading, options):
+        return -1
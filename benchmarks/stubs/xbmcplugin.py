@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-in for Kodi's xbmcplugin module, the listing handed to Kodi is kept in directory
+"""
+import xbmc
+
+SORT_METHOD_UNSORTED, SORT_METHOD_LABEL_IGNORE_THE, SORT_METHOD_EPISODE = 0, 1, 2
+
+# Seconds of video played after setResolvedUrl
+PLAYBACK_SECONDS = 20 * 60
+
+directory = {'items': [], 'content': None, 'ended': False, 'resolved': None}
+
+
+def addDirectoryItems(handle, items, totalItems=0):
+    directory['items'].extend(items)
+    return True
+
+
+def addDirectoryItem(handle, url, listitem, isFolder=False, totalItems=0):
+    directory['items'].append((url, listitem, isFolder))
+    return True
+
+
+def setContent(handle, content):
+    directory['content'] = content
+
+
+def addSortMethod(handle, sortMethod):
+    pass
+
+
+def endOfDirectory(handle, succeeded=True, updateListing=False, cacheToDisc=True):
+    directory['ended'] = True
+
+
+def setResolvedUrl(handle, succeeded, listitem):
+    directory['resolved'] = listitem
+    if succeeded:
+        xbmc.start_playback(PLAYBACK_SECONDS)
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-in for Kodi's xbmcvfs module
+"""
+import os
+
+
+def exists(path):
+    return os.path.exists(path)
+
+
+def mkdir(path):
+    os.makedirs(path)
+    return True
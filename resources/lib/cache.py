@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk HTTP response cache for the Ruutu client
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import urllib
+
+from fileutil import atomic_write
+
+# Endpoint families and how long (seconds) their responses stay fresh.
+# First matching pattern wins, unmatched URLs are never cached.
+TTL_RULES = [
+    (re.compile(r'^https://gatling\.nelonenmedia\.fi/storage/'), None),  # user specific
+    (re.compile(r'^https://gatling\.nelonenmedia\.fi/auth/'), None),
+    (re.compile(r'/api/navigation'), 6 * 60 * 60),
+    (re.compile(r'/api/page/'), 15 * 60),
+    (re.compile(r'/api/(channel|stream)/'), 5 * 60),
+    (re.compile(r'/api/component/336$'), 30 * 60),  # search results per term
+    (re.compile(r'/api/component/'), 10 * 60),
+    (re.compile(r'^https://dynamic-gatling\.nelonenmedia\.fi/cos/videos'), 60 * 60),
+    (re.compile(r'^https://gatling\.nelonenmedia\.fi/recommend'), 10 * 60)
+]
+
+
+class ResponseCache(object):
+    def __init__(self, cache_folder, max_size=20 * 1024 * 1024):
+        self.cache_folder = cache_folder
+        self.max_size = max_size
+        if not os.path.exists(self.cache_folder):
+            os.makedirs(self.cache_folder)
+
+    def ttl_for(self, url):
+        """Return the TTL of the endpoint family the URL belongs to or None if it must not be cached."""
+        for pattern, ttl in TTL_RULES:
+            if pattern.search(url):
+                return ttl
+        return None
+
+    def make_key(self, url, params=None):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        if params:
+            if isinstance(params, dict):
+                params = sorted((k, self._encode(v)) for k, v in params.items() if v is not None)
+            url = url + '?' + urllib.urlencode(params)
+        return hashlib.sha1(url).hexdigest()
+
+    def _encode(self, value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+
+    def _path(self, key):
+        return os.path.join(self.cache_folder, key + '.cache')
+
+    def get(self, key):
+        """Return the cached entry as (meta, body) or None. Stale entries are returned too, check meta['expires']."""
+        try:
+            with open(self._path(key), 'rb') as fh_cache:
+                meta = json.loads(fh_cache.readline())
+                body = fh_cache.read()
+        except (IOError, OSError, ValueError):
+            return None
+
+        # Touch the file, mtime is used as the last access time for LRU eviction
+        try:
+            os.utime(self._path(key), None)
+        except OSError:
+            pass
+
+        return meta, body
+
+    def is_fresh(self, meta):
+        return meta.get('expires', 0) > time.time()
+
+    def put(self, key, url, body, ttl, etag=None, last_modified=None):
+        meta = {
+            'url': url,
+            'stored': time.time(),
+            'expires': time.time() + ttl,
+            'etag': etag,
+            'last_modified': last_modified
+        }
+        self._write(key, meta, body)
+        self.evict()
+
+    def refresh(self, key, meta, body, ttl):
+        """Extend the lifetime of a revalidated (304 Not Modified) entry."""
+        meta['expires'] = time.time() + ttl
+        self._write(key, meta, body)
+
+    def _write(self, key, meta, body):
+        try:
+            atomic_write(self._path(key), json.dumps(meta) + '\n' + body)
+        except (IOError, OSError):
+            pass
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_size."""
+        entries = []
+        total_size = 0
+        for filename in os.listdir(self.cache_folder):
+            path = os.path.join(self.cache_folder, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+        if total_size <= self.max_size:
+            return
+
+        for mtime, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+            if total_size <= self.max_size:
+                break
+
+    def clear(self):
+        for filename in os.listdir(self.cache_folder):
+            try:
+                os.remove(os.path.join(self.cache_folder, filename))
+            except OSError:
+                pass
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Local full-text index of grid items seen in Ruutu responses
+"""
+import re
+import json
+import time
+import sqlite3
+import threading
+
+# Grid items that can be listed again from the index, keyed by their link target type
+KINDS = ('series_id', 'video_id', 'channel_id', 'stream_id')
+
+# Series first in search results, then episodes and movies, live content last
+KIND_ORDER = "CASE kind WHEN 'series_id' THEN 0 WHEN 'video_id' THEN 1 ELSE 2 END"
+
+WORD_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+def item_key(item):
+    """(kind, id) of an indexable grid item or None."""
+    try:
+        target = item['link']['target']
+    except (KeyError, TypeError):
+        return None
+    if target.get('type') not in KINDS or target.get('value') is None:
+        return None
+    return target['type'], unicode(target['value'])
+
+
+def page_items(data):
+    """Grid items inside a grid or page response."""
+    if isinstance(data.get('items'), list):
+        for item in data['items']:
+            yield item
+    for component in data.get('components') or []:
+        content = component.get('content') or {}
+        if isinstance(content.get('items'), list):
+            for item in content['items']:
+                yield item
+
+
+class Catalog(object):
+    """Series, episodes, channels and sport streams of grid responses in SQLite with an FTS4 index.
+
+    Items are stored as they came from the API so that search results can be listed like any grid. Entries not
+    seen for max_age are left out of searches and dropped by prune().
+    """
+
+    def __init__(self, db_file, max_age=7 * 24 * 60 * 60):
+        self.db_file = db_file
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self._fts = None
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_file, timeout=10)
+        if self._fts is None:
+            connection.execute('CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY, kind TEXT, item_id TEXT, '
+                               'title TEXT, data TEXT, updated REAL, UNIQUE (kind, item_id))')
+            try:
+                connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts4(title, text, '
+                                   'tokenize=unicode61)')
+                self._fts = True
+            except sqlite3.OperationalError:
+                # SQLite of the platform was built without FTS4, search falls back to LIKE
+                self._fts = False
+            connection.commit()
+        return connection
+
+    def add(self, data):
+        """Index the grid items of a grid or page response. Return how many were indexed."""
+        rows = []
+        for item in page_items(data):
+            key = item_key(item)
+            if key and item.get('title'):
+                text = u' '.join(unicode(item.get(field) or '')
+                                 for field in ('title_detail', 'subtitle', 'description', 'series'))
+                rows.append((key[0], key[1], item['title'], text, json.dumps(item)))
+        if not rows:
+            return 0
+
+        now = time.time()
+        with self.lock:
+            connection = self._connect()
+            try:
+                for kind, item_id, title, text, item_json in rows:
+                    found = connection.execute('SELECT id FROM items WHERE kind = ? AND item_id = ?',
+                                               (kind, item_id)).fetchone()
+                    if found:
+                        row_id = found[0]
+                        connection.execute('UPDATE items SET title = ?, data = ?, updated = ? WHERE id = ?',
+                                           (title, item_json, now, row_id))
+                    else:
+                        row_id = connection.execute('INSERT INTO items (kind, item_id, title, data, updated) '
+                                                    'VALUES (?, ?, ?, ?, ?)',
+                                                    (kind, item_id, title, item_json, now)).lastrowid
+                    if self._fts:
+                        connection.execute('DELETE FROM items_fts WHERE docid = ?', (row_id,))
+                        connection.execute('INSERT INTO items_fts (docid, title, text) VALUES (?, ?, ?)',
+                                           (row_id, title, text))
+                connection.commit()
+            except sqlite3.Error:
+                connection.rollback()
+                return 0
+            finally:
+                connection.close()
+        return len(rows)
+
+    def search(self, term, limit=200):
+        """Return the stored grid items matching every word of term as a prefix, best kinds first."""
+        words = WORD_PATTERN.findall(term.lower() if isinstance(term, unicode) else term.decode('utf-8').lower())
+        if not words:
+            return []
+        since = time.time() - self.max_age
+
+        with self.lock:
+            connection = self._connect()
+            try:
+                if self._fts:
+                    query = ' '.join(word + '*' for word in words)
+                    rows = connection.execute('SELECT data FROM items JOIN items_fts ON items_fts.docid = items.id '
+                                              'WHERE items_fts MATCH ? AND updated >= ? ORDER BY ' + KIND_ORDER +
+                                              ', items.title LIMIT ?', (query, since, limit)).fetchall()
+                else:
+                    where = ' AND '.join(['title LIKE ?'] * len(words))
+                    rows = connection.execute('SELECT data FROM items WHERE ' + where + ' AND updated >= ? ORDER BY ' +
+                                              KIND_ORDER + ', title LIMIT ?',
+                                              ['%' + word + '%' for word in words] + [since, limit]).fetchall()
+            except sqlite3.Error:
+                return []
+            finally:
+                connection.close()
+        return [json.loads(row[0]) for row in rows]
+
+    def prune(self):
+        """Drop entries that haven't been seen for max_age."""
+        since = time.time() - self.max_age
+        with self.lock:
+            connection = self._connect()
+            try:
+                if self._fts:
+                    connection.execute('DELETE FROM items_fts WHERE docid IN (SELECT id FROM items WHERE updated < ?)',
+                                       (since,))
+                connection.execute('DELETE FROM items WHERE updated < ?', (since,))
+                connection.commit()
+            except sqlite3.Error:
+                connection.rollback()
+            finally:
+                connection.close()
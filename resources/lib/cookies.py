@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Cookie jar that is written to disk only when it has changed
+"""
+import threading
+import cookielib
+
+from fileutil import atomic_write
+
+
+class PersistentCookieJar(cookielib.LWPCookieJar):
+    """LWPCookieJar with dirty tracking and atomic, merging saves.
+
+    save_if_dirty() merges the cookies with the file on disk before replacing it, so two plugin invocations
+    running at the same time don't drop each other's cookies.
+    """
+
+    def __init__(self, filename):
+        cookielib.LWPCookieJar.__init__(self, filename)
+        self.dirty = False
+        self._removed = set()
+        self._save_lock = threading.Lock()
+
+    def set_cookie(self, cookie):
+        cookielib.LWPCookieJar.set_cookie(self, cookie)
+        self._removed.discard((cookie.domain, cookie.path, cookie.name))
+        self.dirty = True
+
+    def clear(self, domain=None, path=None, name=None):
+        if domain is not None and path is not None and name is not None:
+            self._removed.add((domain, path, name))
+        else:
+            # Clearing more than a single cookie, forget everything on disk too
+            self._removed.add(None)
+        cookielib.LWPCookieJar.clear(self, domain, path, name)
+        self.dirty = True
+
+    def load(self, *args, **kwargs):
+        cookielib.LWPCookieJar.load(self, *args, **kwargs)
+        self.dirty = False
+
+    def save_if_dirty(self):
+        with self._save_lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+
+            merged = cookielib.LWPCookieJar(self.filename)
+            if None not in self._removed:
+                try:
+                    merged.load(ignore_discard=True, ignore_expires=True)
+                except (IOError, cookielib.LoadError):
+                    pass
+                for domain, path, name in self._removed:
+                    try:
+                        merged.clear(domain, path, name)
+                    except KeyError:
+                        pass
+            for cookie in self:
+                merged.set_cookie(cookie)
+
+            # Same content as LWPCookieJar.save() writes
+            atomic_write(self.filename, '#LWP-Cookies-2.0\n' +
+                         merged.as_lwp_str(ignore_discard=True, ignore_expires=True))
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Credentials store shared by everything running in one plugin invocation
+"""
+import os
+import json
+
+from fileutil import atomic_write
+
+
+class Credentials(object):
+    """Loads the credentials file once and reloads it only when the file changes on disk."""
+
+    def __init__(self, credentials_file):
+        self.credentials_file = credentials_file
+        self._data = None
+        self._stamp = None
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.credentials_file)
+            return stat.st_mtime, stat.st_size
+        except OSError:
+            return None
+
+    @property
+    def data(self):
+        stamp = self._file_stamp()
+        if self._data is None or stamp != self._stamp:
+            if stamp is None:
+                self.save({})
+            else:
+                try:
+                    with open(self.credentials_file, 'r') as fh_credentials:
+                        self._data = json.loads(fh_credentials.read())
+                except (IOError, ValueError):
+                    self._data = {}
+                self._stamp = stamp
+        return self._data
+
+    def save(self, credentials):
+        atomic_write(self.credentials_file, json.dumps(credentials))
+        self._data = credentials
+        self._stamp = self._file_stamp()
+
+    def reset(self):
+        self.save({})
+
+    @property
+    def account_id(self):
+        return self.data.get('accountId')
+
+    @property
+    def token(self):
+        return self.data.get('token')
+
+    @property
+    def role(self):
+        # For registered user ruutuRole is null
+        if not self.account_id:
+            return 'anonymous'
+        service = self.data.get('service') or {}
+        if service.get('ruutuRole') is None:
+            return 'authenticated'  # Logged in user without Ruutu+
+        return service['ruutuRole']  # Ruutu+ user
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Local copy of the user's Ruutu favorites
+"""
+import json
+import time
+import threading
+
+from fileutil import atomic_write
+
+ADD, REMOVE = 'add', 'remove'
+
+
+class FavoritesMirror(object):
+    """Favorites of one account as last seen on the server plus changes not sent yet.
+
+    Toggling a favorite only records a pending change, listings see it at once. sync() in Ruutu sends the
+    pending changes and replaces the server copy, the file is read again on every call so concurrent plugin
+    invocations and the service see each other's changes.
+    """
+
+    def __init__(self, mirror_file, max_age=10 * 60):
+        self.mirror_file = mirror_file
+        self.max_age = max_age
+        self.lock = threading.Lock()
+
+    def _load(self, account_id):
+        try:
+            with open(self.mirror_file, 'r') as fh_favorites:
+                data = json.loads(fh_favorites.read())
+        except (IOError, ValueError):
+            data = {}
+        if data.get('account_id') != account_id:
+            # Another user logged in, nothing of the old mirror applies
+            data = {'account_id': account_id, 'synced': 0, 'items': [], 'pending': {}}
+        return data
+
+    def _save(self, data):
+        try:
+            atomic_write(self.mirror_file, json.dumps(data))
+        except (IOError, OSError):
+            pass
+
+    def synced(self, account_id):
+        """False until the server copy has been fetched at least once for account_id."""
+        return self._load(account_id)['synced'] > 0
+
+    def is_stale(self, account_id):
+        return time.time() - self._load(account_id)['synced'] >= self.max_age
+
+    def items(self, account_id):
+        """Favorites in the format of storage/favorite with pending changes applied."""
+        data = self._load(account_id)
+        pending = data['pending']
+        items = [x for x in data['items'] if pending.get(str(x['item'])) != REMOVE]
+        known = set(str(x['item']) for x in items)
+        items.extend({'item': item, 'type': 'series'}
+                     for item, change in sorted(pending.items()) if change == ADD and item not in known)
+        return items
+
+    def pending(self, account_id):
+        return self._load(account_id)['pending']
+
+    def set_favorite(self, account_id, series_id, favorite):
+        with self.lock:
+            data = self._load(account_id)
+            data['pending'][str(series_id)] = ADD if favorite else REMOVE
+            self._save(data)
+
+    def sent(self, account_id, series_id, change):
+        """Drop a pending change after the server accepted it, unless it was toggled again meanwhile."""
+        with self.lock:
+            data = self._load(account_id)
+            if data['pending'].get(str(series_id)) == change:
+                del data['pending'][str(series_id)]
+                self._save(data)
+
+    def replace(self, account_id, items):
+        """Store the server copy, pending changes stay on top of it until they are sent."""
+        with self.lock:
+            data = self._load(account_id)
+            data['items'] = list(items or [])
+            data['synced'] = time.time()
+            self._save(data)
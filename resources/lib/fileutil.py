@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+File helpers shared by the state files in the profile folder
+"""
+import os
+import thread
+
+
+def atomic_write(path, data):
+    """Replace the file at path with data so that readers see either the old or the new content.
+
+    Plugin invocations, the service and their threads write the same files, the temporary file is unique to the
+    writing thread. IOError and OSError are left to the caller.
+    """
+    tmp_path = '%s.%s.%s.tmp' % (path, os.getpid(), thread.get_ident())
+    try:
+        with open(tmp_path, 'wb') as fh_tmp:
+            fh_tmp.write(data)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Windows can't rename over an existing file
+            os.remove(path)
+            os.rename(tmp_path, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
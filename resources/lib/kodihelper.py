@@ -4,8 +4,15 @@ import os
 import urllib
 import re
 import sys
+import time
 
-from ruutu import Ruutu
+from ruutu import Ruutu, LOG_DEBUG, LOG_INFO, LOG_WARNING, LOG_ERROR
+from thumbnails import ThumbnailCache
+from localserver import image_url
+from settings import Settings, LocalizedStrings
+from workers import Task
+from paging import PageSizer
+from searches import SearchHistory
 
 import xbmc
 import xbmcvfs
@@ -15,8 +22,43 @@ from xbmcaddon import Addon
 import inputstreamhelper
 import AddonSignals
 
-from PIL import Image
-from StringIO import StringIO
+# Window property where the service publishes the address of its local server
+SERVICE_PROPERTY = 'plugin.video.ruutu.service'
+# Comma separated endpoints the local server answers, 'image' and 'fetch'
+SERVICE_ENDPOINTS_PROPERTY = SERVICE_PROPERTY + '.endpoints'
+
+# Directory items are handed to Kodi in batches of this size
+LISTING_BATCH_SIZE = 100
+
+# Values of the fanart_size setting
+FANART_WIDTHS = [None, 1280, 960]
+
+# Ruutu log levels in the Kodi log
+KODI_LOG_LEVELS = {
+    LOG_DEBUG: xbmc.LOGDEBUG,
+    LOG_INFO: xbmc.LOGINFO,
+    LOG_WARNING: xbmc.LOGWARNING,
+    LOG_ERROR: xbmc.LOGERROR
+}
+
+# Seconds between playback progress checkpoints and how long queued progress may take to send after playback
+PROGRESS_CHECKPOINT_INTERVAL = 30
+PROGRESS_FLUSH_WAIT = 5
+
+# Stream of the next episode is resolved when this many seconds are left, earlier its signed URLs would expire
+NEXT_STREAM_PREFETCH_TIME = 3 * 60
+
+def configure_ruutu(ruutu, settings, logging_prefix):
+    """Apply the logging, tracing and connection settings to a Ruutu client of the plugin or the service."""
+    def log_handler(level, string):
+        xbmc.log(msg='%s: [Ruutu] %s' % (logging_prefix, string), level=KODI_LOG_LEVELS[level])
+
+    ruutu.debug = settings.debug_logging
+    ruutu.log_level = LOG_DEBUG if settings.debug_logging else LOG_INFO
+    ruutu.log_handler = log_handler
+    ruutu.tracer.enabled = settings.tracing
+    ruutu.timeout = (settings.connect_timeout, settings.read_timeout)
+    ruutu.max_retries = settings.http_retries
 
 class KodiHelper(object):
     def __init__(self, base_url=None, handle=None):
@@ -27,11 +69,31 @@ class KodiHelper(object):
         self.addon_profile = xbmc.translatePath(addon.getAddonInfo('profile'))
         self.addon_name = addon.getAddonInfo('id')
         self.addon_version = addon.getAddonInfo('version')
-        self.language = addon.getLocalizedString
+        self.addon_icon = addon.getAddonInfo('icon')
+        self.addon_fanart = addon.getAddonInfo('fanart')
+        self.language = LocalizedStrings(addon)
+        self.settings = Settings(addon, os.path.join(self.addon_path, 'resources', 'settings.xml'))
         self.logging_prefix = '[%s-%s]' % (self.addon_name, self.addon_version)
         if not xbmcvfs.exists(self.addon_profile):
             xbmcvfs.mkdir(self.addon_profile)
-        self.r = Ruutu(self.addon_profile, True)
+        self.r = Ruutu(self.addon_profile, self.settings.debug_logging)
+        configure_ruutu(self.r, self.settings, self.logging_prefix)
+        if self.check_for_credentials():
+            self.r.login_handler = self.login_process
+        self.thumbnails = ThumbnailCache(self.r.tempdir, os.path.join(self.addon_path, 'resources', 'sticker.png'),
+                                         lambda url: self.r.make_request(url, 'get'), tracer=self.r.tracer)
+        # Without adaptive page size the bounds are equal and the page size is items_per_page
+        max_page_size = self.settings.max_items_per_page if self.settings.adaptive_page_size else 0
+        self.page_sizer = PageSizer(os.path.join(self.addon_profile, 'page_size'), self.settings.items_per_page,
+                                    max_page_size)
+        self.search_history = SearchHistory(os.path.join(self.addon_profile, 'search_history'))
+        self._service_url = None
+        self._service_endpoints = None
+        if self.settings.use_service and self.service_serves('fetch'):
+            self.r.relay_url = self.service_url
+        self.listing = []
+        self.content = None
+        self.total_items = 0
         AddonSignals.registerSlot('upnextprovider', self.addon_name + '_play_action', self.play_upnext)
 
     def get_addon(self):
@@ -39,16 +101,10 @@ class KodiHelper(object):
         return Addon()
 
     def get_setting(self, setting_id):
-        addon = self.get_addon()
-        setting = addon.getSetting(setting_id)
-        if setting == 'true':
-            return True
-        elif setting == 'false':
-            return False
-        else:
-            return setting
+        return self.settings.get(setting_id)
 
     def set_setting(self, key, value):
+        self.settings.update(key, value)
         return self.get_addon().setSetting(key, value)
 
     def log(self, string):
@@ -99,16 +155,8 @@ class KodiHelper(object):
         # "ruutu_plus_viihde",
         # "subscriber"
         # ],
-
-        # For registered user ruutuRole is null
         if self.check_for_credentials():
-            if self.r.get_credentials().get('accountId'):
-                if self.r.get_credentials()['service']['ruutuRole'] is None:
-                    return 'authenticated' # Logged in user without Ruutu+
-                else:
-                    return self.r.get_credentials()['service']['ruutuRole'] # Ruutu+ user
-            else:
-                return 'anonymous' # Credentials file not found
+            return self.r.credentials.role
         else:
             return 'anonymous' # Not logged in user
 
@@ -117,23 +165,52 @@ class KodiHelper(object):
         password = self.get_setting('password')
         self.r.login(username, password)
 
+    def ensure_session(self):
+        """Log in only when there is no usable session for the configured user."""
+        if not self.r.session_valid(self.get_setting('username')):
+            self.login_process()
+
     def reset_credentials(self):
         self.r.reset_credentials() # Reset credentials file
         self.set_setting('username', '')
         self.set_setting('password', '')
 
-    def create_ruutuplus_thumb(self, thumb_url, id):
-        thumb = self.r.make_request(thumb_url, 'get')
-
-        background = Image.open(StringIO(thumb))
-        foreground = Image.open(self.addon_path + '/resources/sticker.png')
-
-        background.paste(foreground, (5, 5), foreground)
-        background.save(self.r.tempdir + '/' + str(id) + '.png')
-        return self.r.tempdir + '/' + str(id) + '.png'
+    @property
+    def service_url(self):
+        """Address of the local server run by the addon service or an empty string when it's not running."""
+        if self._service_url is None:
+            self._service_url = xbmcgui.Window(10000).getProperty(SERVICE_PROPERTY)
+        return self._service_url
+
+    def service_serves(self, endpoint):
+        """Whether the running local server answers endpoint, the service may not have caught up with settings."""
+        if self._service_endpoints is None:
+            self._service_endpoints = xbmcgui.Window(10000).getProperty(SERVICE_ENDPOINTS_PROPERTY).split(',')
+        return bool(self.service_url) and endpoint in self._service_endpoints
+
+    @property
+    def image_proxy(self):
+        return self.service_url if self.settings.image_proxy and self.service_serves('image') else ''
+
+    def create_ruutuplus_thumb(self, thumb_url):
+        if self.image_proxy:
+            return image_url(self.image_proxy, thumb_url, sticker=True)
+        return self.thumbnails.get(thumb_url)
+
+    def prepare_ruutuplus_thumbs(self, thumb_urls):
+        # Image proxy creates thumbs when Kodi asks for them
+        if not self.image_proxy:
+            self.thumbnails.prepare(thumb_urls)
+
+    def fanart_url(self, url):
+        if not url:
+            return None
+        width = FANART_WIDTHS[self.settings.fanart_size]
+        if width and self.image_proxy:
+            return image_url(self.image_proxy, url, width=width)
+        return url
 
     def add_item(self, title, params, items=False, folder=True, playable=False, info=None, art=None, content=False, menu=None, resume=None, total=None):
-        addon = self.get_addon()
         listitem = xbmcgui.ListItem(label=title)
 
         if playable:
@@ -146,28 +223,62 @@ class KodiHelper(object):
             listitem.setArt(art)
         else:
             art = {
-                'icon': addon.getAddonInfo('icon'),
-                'fanart': addon.getAddonInfo('fanart')
+                'icon': self.addon_icon,
+                'fanart': self.addon_fanart
             }
             listitem.setArt(art)
         if info:
             listitem.setInfo('video', info)
         if content:
-            xbmcplugin.setContent(self.handle, content)
+            self.set_content(content)
         if menu:
             listitem.addContextMenuItems(menu)
 
         recursive_url = self.base_url + '?' + urllib.urlencode(params)
 
         if items is False:
-            xbmcplugin.addDirectoryItem(self.handle, recursive_url, listitem, folder)
+            self.listing.append((recursive_url, listitem, folder))
+            if len(self.listing) >= LISTING_BATCH_SIZE:
+                self.flush()
         else:
             items.append((recursive_url, listitem, folder))
             return items
 
+    def set_content(self, content):
+        """Content type of the listing, passed to Kodi once when the listing ends."""
+        self.content = content
+
+    def set_total_items(self, total_items):
+        """Hint Kodi how many items the listing will have."""
+        self.total_items = total_items
+
+    def flush(self):
+        """Hand the collected directory items to Kodi."""
+        if self.listing:
+            with self.r.tracer.span('kodi', call='addDirectoryItems', items=len(self.listing)):
+                xbmcplugin.addDirectoryItems(self.handle, self.listing, totalItems=max(self.total_items, len(self.listing)))
+            self.listing = []
+
     def eod(self):
         """Tell Kodi that the end of the directory listing is reached."""
-        xbmcplugin.endOfDirectory(self.handle)
+        if self.content:
+            xbmcplugin.setContent(self.handle, self.content)
+        self.flush()
+        xbmcplugin.addSortMethod(self.handle, xbmcplugin.SORT_METHOD_UNSORTED)
+        xbmcplugin.addSortMethod(self.handle, xbmcplugin.SORT_METHOD_LABEL_IGNORE_THE)
+        if self.content == 'episodes':
+            xbmcplugin.addSortMethod(self.handle, xbmcplugin.SORT_METHOD_EPISODE)
+        with self.r.tracer.span('kodi', call='endOfDirectory'):
+            xbmcplugin.endOfDirectory(self.handle)
+
+    def set_favorite(self, series_id, favorite):
+        # Listings show the change right away from the local mirror, Ruutu is updated after that
+        self.r.set_favorite(series_id, favorite)
+        xbmc.executebuiltin('Container.Refresh')
+        try:
+            self.r.sync_favorites()
+        except Exception as error:
+            self.log('Syncing favorites failed, trying again later: %s' % error)
 
     def play_upnext(self, data):
         self.log('Start playing from UpNext')
@@ -181,6 +292,13 @@ class KodiHelper(object):
         if self.check_userrole() in ('authenticated', 'anonymous') and sticker == 'entertainment':
             self.dialog('ok', self.language(30006), self.language(30012))
         else:
+            # Episode info and watch history don't depend on the stream, fetch them while the stream is resolved
+            if type == 'video':
+                episode_info_task = Task(self.r.get_episode_info, video_id)
+                if self.r.credentials.account_id:
+                    # Only the history, syncing favorites is left to the service and the listings
+                    watch_state_task = Task(self.r.get_history_state)
+
             stream = self.r.get_stream(video_id, type)
             playitem = xbmcgui.ListItem(path=stream['video_url'])
 
@@ -192,14 +310,16 @@ class KodiHelper(object):
                     playitem.setProperty('inputstream.adaptive.manifest_type', 'mpd')
                     playitem.setProperty('inputstream.adaptive.license_type', 'com.widevine.alpha')
 
-                    license_url = stream['license_url'] + '&token=' + stream['drm_token']
-
-                    playitem.setProperty('inputstream.adaptive.license_key', license_url + '||R{SSM}|')
+                    if stream.get('license_url'):
+                        license_url = stream['license_url'] + '&token=' + stream['drm_token']
+                        playitem.setProperty('inputstream.adaptive.license_key', license_url + '||R{SSM}|')
+                    else:
+                        self.log('No license URL in the manifest of %s' % video_id)
 
             if type == 'video':
 
                 # Get current episode info
-                current_ep_info = self.r.get_episode_info(video_id)
+                current_ep_info = episode_info_task.result()
                 info = {
                     'mediatype': 'episode',
                     'title': current_ep_info['videos'][0]['episode_name'] if current_ep_info['videos'][0].get(
@@ -224,31 +344,17 @@ class KodiHelper(object):
                 playitem.setArt(art)
 
                 # Watched status from Ruutu
-                if self.r.get_credentials().get('accountId'):
-                    history = self.r.get_page('https://gatling.nelonenmedia.fi/storage/history?unfinished=true&gatling_token=' + self.r.get_credentials()['token'])
-                    user_unfinished_videos = ",".join([str(x['video']) for x in history])
-
-                    if str(current_ep_info['videos'][0]['id']) in user_unfinished_videos:
-                        for h in history:
-                            if h['video'] == current_ep_info['videos'][0]['id']:
-                                if h['unfinished'] is False: # Watched video
-                                    resume = 0
-                                    total = current_ep_info['videos'][0].get('runtime')
-                                elif h['watched'] is None: # Unwatched video
-                                    resume = 0
-                                    total = 1
-                                else: # Partly watched
-                                    self.log('Resume from: ' + str(h['watched']))
-                                    resume = h['watched']
-                                    total = current_ep_info['videos'][0].get('runtime')
-                    else: # Unwatched video
-                        resume = 0
-                        total = 1
+                if self.r.credentials.account_id:
+                    watch_state = watch_state_task.result()
+                    playcount, resume, total = watch_state.resume_info(current_ep_info['videos'][0]['id'],
+                                                                       current_ep_info['videos'][0].get('runtime'))
+                    if resume:
+                        self.log('Resume from: ' + str(resume))
 
                     playitem.setProperty("ResumeTime", str(resume))
                     playitem.setProperty("TotalTime", str(total))
 
-            player = RuutuPlayer()
+            player = RuutuPlayer(self)
             player.resolve(playitem)
 
             if type == 'video':
@@ -256,21 +362,40 @@ class KodiHelper(object):
                 player.current_episode_info = info
                 player.current_episode_art = art
 
-                if self.r.get_credentials().get('accountId'):
-
-                    while not xbmc.abortRequested and player.running:
-                        if player.isPlayingVideo():
-                            player.video_totaltime = player.getTotalTime()
-                            player.video_lastpos = player.getTime()
-                            player.logged_in = True
-
-                        xbmc.sleep(1000)
+                # Keep running until playback ends, a stream that fails to play is dropped from the stream cache
+                last_checkpoint = time.time()
+                flush_task = None
+                next_stream_task = None
+                while not xbmc.abortRequested and player.running:
+                    if player.isPlayingVideo():
+                        player.video_totaltime = player.getTotalTime()
+                        player.video_lastpos = player.getTime()
+
+                        # Playing the next episode from UpNext finds its stream in the stream cache
+                        if player.next_video_id and next_stream_task is None \
+                                and player.video_totaltime - player.video_lastpos <= NEXT_STREAM_PREFETCH_TIME:
+                            next_stream_task = Task(player.prefetch_next_stream)
+
+                    if self.r.credentials.account_id and player.isPlayingVideo():
+                        player.logged_in = True
+
+                        # Checkpoints only go to the local queue, it is sent to Ruutu in the background
+                        if time.time() - last_checkpoint >= PROGRESS_CHECKPOINT_INTERVAL:
+                            last_checkpoint = time.time()
+                            self.r.progress.checkpoint(self.r.credentials.account_id, video_id, player.video_lastpos)
+                            if flush_task is None or flush_task.done():
+                                flush_task = Task(self.r.flush_progress)
+
+                    xbmc.sleep(1000)
+
+                if player.logged_in:
+                    # Whatever doesn't make it in time is sent later by the service
+                    Task(self.r.flush_progress).result(PROGRESS_FLUSH_WAIT)
+                    xbmc.executebuiltin('Container.Refresh')
 
 class RuutuPlayer(xbmc.Player):
-    def __init__(self):
-        base_url = sys.argv[0]
-        handle = int(sys.argv[1])
-        self.helper = KodiHelper(base_url, handle)
+    def __init__(self, helper):
+        self.helper = helper
         self.video_id = 0
         self.current_episode_info = ''
         self.current_episode_art = ''
@@ -278,12 +403,33 @@ class RuutuPlayer(xbmc.Player):
         self.video_totaltime = 0
         self.running = False
         self.logged_in = False
+        self.upnext_task = None
+        # Set by send_upnext_data when the next episode can be played
+        self.next_video_id = None
 
     def resolve(self, li):
         xbmcplugin.setResolvedUrl(self.helper.handle, True, listitem=li)
         self.running = True
 
     def onPlayBackStarted(self):
+        # Keep the player callback thread free, the next episode is prepared while this one plays
+        if self.upnext_task is None:
+            self.upnext_task = Task(self.prepare_upnext)
+
+    def prepare_upnext(self):
+        try:
+            self.send_upnext_data()
+        except Exception as error:
+            self.helper.log('Could not prepare next episode: %s' % error)
+
+    def prefetch_next_stream(self):
+        try:
+            self.helper.r.get_stream(self.next_video_id, 'video')
+        except Exception as error:
+            self.helper.log('Could not prefetch next stream: %s' % error)
+
+    def send_upnext_data(self):
+        """Fetch the next episode for UpNext, its stream is resolved by play_item close to the end."""
         self.helper.log('Getting next episode info')
         next_ep_id = self.helper.r.get_next_episode_id(self.video_id)
 
@@ -342,6 +488,9 @@ class RuutuPlayer(xbmc.Player):
             play_info['video_id'] = next_ep_info['videos'][0]['id']
             play_info['sticker'] = sticker
 
+            if not (sticker == 'entertainment' and self.helper.check_userrole() in ('authenticated', 'anonymous')):
+                self.next_video_id = play_info['video_id']
+
             next_info = {
                 'current_episode': current_episode,
                 'next_episode': next_episode,
@@ -354,18 +503,22 @@ class RuutuPlayer(xbmc.Player):
         else:
             self.helper.log('No next episode available')
 
+    def onPlayBackError(self):
+        if self.running:
+            self.running = False
+            self.helper.log('Playback error, forgetting stream of video id:' + str(self.video_id))
+            self.helper.r.invalidate_stream(self.video_id)
+
     def onPlayBackEnded(self):
-        if self.logged_in:
-            if self.running:
-                self.running = False
+        if self.running:
+            if self.logged_in:
                 self.helper.log('Playback ended')
-                self.helper.r.update_finished(self.video_id, self.helper.r.get_credentials()['token'])
-                return xbmc.executebuiltin('Container.Refresh')
+                self.helper.r.progress.finish(self.helper.r.credentials.account_id, self.video_id)
+            self.running = False
 
     def onPlayBackStopped(self):
-        if self.logged_in:
-            if self.running:
-                self.running = False
+        if self.running:
+            if self.logged_in:
                 self.helper.log('Stopped video id:' + str(self.video_id))
                 video_lastpos2 = format(self.video_lastpos, '.2f')
                 video_totaltime2 = format(self.video_totaltime, '.2f')
@@ -373,9 +526,9 @@ class RuutuPlayer(xbmc.Player):
                 self.helper.log('lastpos: ' + video_lastpos2)
 
                 if (self.video_lastpos * 100) / self.video_totaltime >= 90:  # Watched
-                    self.helper.r.update_finished(self.video_id, self.helper.r.get_credentials()['token'])
-                    return xbmc.executebuiltin('Container.Refresh')
+                    self.helper.r.progress.finish(self.helper.r.credentials.account_id, self.video_id)
                 else:
-                    self.helper.r.update_unfinished(self.video_id, video_lastpos2, self.helper.r.get_credentials()['token'])
-                    return xbmc.executebuiltin('Container.Refresh')
+                    self.helper.r.progress.checkpoint(self.helper.r.credentials.account_id, self.video_id,
+                                                      self.video_lastpos)
+            self.running = False
 
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP service run by the addon service
+
+/image stickers and downscales artwork when Kodi asks for it, /fetch relays
+API requests through the service's long-lived Ruutu session.
+"""
+import os
+import shutil
+import threading
+import urllib
+import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        parsed = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(parsed.query))
+        if parsed.path == '/image' and self.server.thumbnails and query.get('url'):
+            self.serve_image(query)
+        elif parsed.path == '/fetch' and self.server.relay and query.get('url'):
+            self.serve_fetch(query)
+        elif parsed.path == '/invalidate' and self.server.relay:
+            self.server.relay.invalidate()
+            self.send_body('', 'text/plain')
+        else:
+            self.send_error(404)
+
+    def serve_image(self, query):
+        """GET /image?url=<source image>[&sticker=1][&width=<max width>]"""
+        try:
+            width = int(query['width']) if query.get('width') else None
+            path = self.server.thumbnails.get(query['url'], sticker=query.get('sticker') == '1', width=width)
+        except Exception as error:
+            self.server.log('Image proxy failed for %s: %s' % (query['url'], error))
+            self.send_error(502)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png' if path.endswith('.png') else 'image/jpeg')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.send_header('Cache-Control', 'max-age=86400')
+        self.end_headers()
+        with open(path, 'rb') as fh_image:
+            shutil.copyfileobj(fh_image, self.wfile)
+
+    def serve_fetch(self, query):
+        """GET /fetch?url=<API URL with query string>"""
+        # Only Ruutu API calls go out with the service's session
+        if not self.server.relay.relayable(query['url']):
+            self.send_error(403)
+            return
+        try:
+            status_code, body = self.server.relay.fetch(query['url'])
+        except Exception as error:
+            self.server.log('Relay failed for %s: %s' % (query['url'], error))
+            self.send_error(502)
+            return
+        # The upstream status is passed on so errors are never mistaken for content
+        self.send_body(body, 'application/octet-stream', status_code)
+
+    def send_body(self, body, content_type, status_code=200):
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalServer(object):
+    def __init__(self, thumbnails=None, relay=None, host='127.0.0.1', port=0, log=None):
+        """thumbnails is a ThumbnailCache, its fetch function decides where the source images come from.
+
+        relay has fetch(url) returning (status code, response body), relayable(url) telling which URLs it may
+        fetch and invalidate() dropping what it remembers.
+        """
+        self.server = ThreadedHTTPServer((host, port), RequestHandler)
+        self.server.thumbnails = thumbnails
+        self.server.relay = relay
+        self.server.log = log or (lambda string: None)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%s' % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def image_url(server_url, url, sticker=False, width=None):
+    """Build the URL Kodi should use for the image url."""
+    params = {'url': url.encode('utf-8') if isinstance(url, unicode) else url}
+    if sticker:
+        params['sticker'] = 1
+    if width:
+        params['width'] = width
+    return server_url + '/image?' + urllib.urlencode(params)
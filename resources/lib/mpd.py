@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming DASH manifest reading
+"""
+import xml.etree.cElementTree as ET
+
+
+class ChunkReader(object):
+    """File-like object over an iterable of byte chunks, for iterparse."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def find_license_url(chunks):
+    """Return the PlayReady license URL of a DASH manifest given as byte chunks, or None.
+
+    Parsing stops at the first ms:laurl (or mspr:la_url) element of any Period and ContentProtection, the rest
+    of the manifest is never read. Finished elements are cleared so no tree is kept in memory.
+    """
+    for event, element in ET.iterparse(ChunkReader(chunks), events=('start', 'end')):
+        name = local_name(element.tag)
+        if event == 'start':
+            if name == 'laurl' and element.get('licenseUrl'):
+                return element.get('licenseUrl')
+        else:
+            if name == 'la_url' and element.text and element.text.strip():
+                return element.text.strip()
+            element.clear()
+    return None
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Page size that follows how fast grid pages load
+"""
+import json
+
+from fileutil import atomic_write
+
+# A page should load in about this many seconds and weigh at most this many bytes
+TARGET_SECONDS = 1.0
+TARGET_BYTES = 512 * 1024
+
+
+class PageSizer(object):
+    """Learns a page size between min_size and max_size from measured grid fetches, kept in the profile folder."""
+
+    def __init__(self, state_file, min_size, max_size):
+        self.state_file = state_file
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        try:
+            with open(self.state_file, 'r') as fh_state:
+                self._size = float(json.loads(fh_state.read())['size'])
+        except (IOError, ValueError, KeyError, TypeError):
+            self._size = float(self.min_size)
+
+    def size(self):
+        return int(min(self.max_size, max(self.min_size, round(self._size))))
+
+    def record(self, items, seconds, size_bytes=None):
+        """Take a network fetch of items into account. Cache hits shouldn't be recorded, they say nothing."""
+        if items <= 0 or seconds <= 0:
+            return
+        target = TARGET_SECONDS / (seconds / items)
+        if size_bytes:
+            target = min(target, TARGET_BYTES / (float(size_bytes) / items))
+        # Move halfway to the new estimate so a single slow response doesn't shrink pages to the minimum
+        self._size = min(self.max_size, max(self.min_size, (self._size + target) / 2))
+        self._save()
+
+    def _save(self):
+        try:
+            atomic_write(self.state_file, json.dumps({'size': self._size}))
+        except (IOError, OSError):
+            pass
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Playback progress waiting to be sent to Ruutu
+"""
+import time
+import sqlite3
+import threading
+
+
+class ProgressQueue(object):
+    """Durable write-behind queue of playback progress, one row per account and video.
+
+    Checkpoints of the same video are coalesced, only the latest position or finished state is sent. Rows stay in
+    the database until they have been sent, so progress survives crashes and network errors. Rows of an account are
+    only sent with that account's session.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self._created = False
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_file, timeout=10)
+        if not self._created:
+            connection.execute('CREATE TABLE IF NOT EXISTS progress (account_id TEXT, video_id TEXT, position REAL, '
+                               'finished INTEGER, updated REAL, attempts INTEGER, next_try REAL, '
+                               'PRIMARY KEY (account_id, video_id))')
+            connection.commit()
+            self._created = True
+        return connection
+
+    def _execute(self, sql, args=()):
+        with self.lock:
+            connection = self._connect()
+            try:
+                rows = connection.execute(sql, args).fetchall()
+                connection.commit()
+                return rows
+            finally:
+                connection.close()
+
+    def checkpoint(self, account_id, video_id, position):
+        self._execute('INSERT OR REPLACE INTO progress VALUES (?, ?, ?, 0, ?, 0, 0)',
+                      (str(account_id), str(video_id), position, time.time()))
+
+    def finish(self, account_id, video_id):
+        self._execute('INSERT OR REPLACE INTO progress VALUES (?, ?, 0, 1, ?, 0, 0)',
+                      (str(account_id), str(video_id), time.time()))
+
+    def pending(self, account_id):
+        """Return [(video_id, position, finished, updated, attempts)] of account_id that are due to be sent."""
+        return self._execute('SELECT video_id, position, finished, updated, attempts FROM progress '
+                             'WHERE account_id = ? AND next_try <= ? ORDER BY updated', (str(account_id), time.time()))
+
+    def remove(self, account_id, video_id, updated):
+        # A newer checkpoint written while this one was being sent stays queued
+        self._execute('DELETE FROM progress WHERE account_id = ? AND video_id = ? AND updated = ?',
+                      (str(account_id), video_id, updated))
+
+    def retry_later(self, account_id, video_id, updated, attempts, delay):
+        self._execute('UPDATE progress SET attempts = ?, next_try = ? '
+                      'WHERE account_id = ? AND video_id = ? AND updated = ?',
+                      (attempts, time.time() + delay, str(account_id), video_id, updated))
+
+    def count(self, account_id):
+        return self._execute('SELECT COUNT(*) FROM progress WHERE account_id = ?', (str(account_id),))[0][0]
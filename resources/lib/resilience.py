@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Retry delays and a per-host circuit breaker for the Ruutu client
+"""
+import json
+import time
+import random
+import threading
+
+from fileutil import atomic_write
+
+
+def backoff_delay(attempt, base=0.5, cap=8.0):
+    """Jittered exponential delay in seconds before retry number attempt (starting from 0)."""
+    return min(cap, base * (2 ** attempt)) * random.uniform(0.5, 1.5)
+
+
+class CircuitBreaker(object):
+    """Stops sending requests to a host after consecutive failures.
+
+    The state is kept in the profile folder, every plugin invocation is a new process and should know a host
+    is flapping without finding it out the slow way again.
+    """
+
+    def __init__(self, state_file, failure_threshold=3, reset_timeout=60):
+        self.state_file = state_file
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        try:
+            with open(self.state_file, 'r') as fh_state:
+                self.hosts = json.loads(fh_state.read())
+        except (IOError, ValueError):
+            self.hosts = {}
+
+    def allow(self, host):
+        """False while the circuit of host is open. After reset_timeout one trial request is let through."""
+        with self.lock:
+            state = self.hosts.get(host)
+            if not state or state['failures'] < self.failure_threshold:
+                return True
+            if time.time() - state['opened'] >= self.reset_timeout:
+                # Half-open, give the host another chance
+                state['opened'] = time.time()
+                self._save()
+                return True
+            return False
+
+    def record_success(self, host):
+        with self.lock:
+            if host in self.hosts:
+                del self.hosts[host]
+                self._save()
+
+    def record_failure(self, host):
+        with self.lock:
+            state = self.hosts.setdefault(host, {'failures': 0, 'opened': 0})
+            state['failures'] += 1
+            if state['failures'] >= self.failure_threshold:
+                state['opened'] = time.time()
+            self._save()
+
+    def _save(self):
+        try:
+            atomic_write(self.state_file, json.dumps(self.hosts))
+        except (IOError, OSError):
+            pass
@@ -3,10 +3,11 @@
 A Kodi-agnostic library for Ruutu
 """
 import os
+import re
 import json
 import codecs
-import cookielib
 import time
+import threading
 from datetime import datetime
 
 import requests
@@ -15,21 +16,84 @@ from bs4 import BeautifulSoup
 import xmltodict
 import urllib
 
+from cache import ResponseCache
+from credentials import Credentials
+from cookies import PersistentCookieJar
+from workers import map_parallel, Task
+from watchstate import WatchState
+from resilience import CircuitBreaker, backoff_delay
+from tracing import Tracer, endpoint_name
+from mpd import find_license_url
+from streams import StreamCache
+from progress import ProgressQueue
+from favorites import FavoritesMirror, ADD
+from catalog import Catalog
+from fileutil import atomic_write
+
+LOG_DEBUG, LOG_INFO, LOG_WARNING, LOG_ERROR = range(4)
+
+# Longest part of a response body written to the debug log
+LOG_BODY_LIMIT = 2048
+
+# Tokens and passwords are masked in log messages
+SECRET_PATTERN = re.compile(
+    r'''((?:gatling_token|access_token|playToken|token|password|_csrf)['"]?\s*[=:]\s*u?['"]?)[^&'"\s,}]+''')
+
+STORAGE_URL = 'https://gatling.nelonenmedia.fi/storage/'
+NAVIGATION_URL = 'https://prod-component-api.nm-services.nelonenmedia.fi/api/navigation/?app=ruutu&client=web'
+
+# How long a resolved channel_id/stream_id -> video_id mapping is trusted
+VIDEO_ID_TTL = 5 * 60
+
+# Gatling doesn't tell how long a session token lives, this is used until an expiry is observed
+SESSION_MAX_AGE = 7 * 24 * 60 * 60
+
 class Ruutu(object):
     def __init__(self, settings_folder, debug=False):
         self.debug = debug
+        self.log_level = LOG_DEBUG if debug else LOG_INFO
+        # Called with (level, message) instead of printing when set
+        self.log_handler = None
         self.http_session = requests.Session()
         self.settings_folder = settings_folder
         self.tempdir = os.path.join(settings_folder, 'tmp')
         if not os.path.exists(self.tempdir):
             os.makedirs(self.tempdir)
-        self.cookie_jar = cookielib.LWPCookieJar(os.path.join(self.settings_folder, 'cookie_file'))
+        self.cookie_jar = PersistentCookieJar(os.path.join(self.settings_folder, 'cookie_file'))
         self.credentials_file = os.path.join(settings_folder, 'credentials')
+        self.credentials = Credentials(self.credentials_file)
         try:
             self.cookie_jar.load(ignore_discard=True, ignore_expires=True)
         except IOError:
             pass
         self.http_session.cookies = self.cookie_jar
+        self.cache = ResponseCache(os.path.join(settings_folder, 'cache'))
+        # Called without arguments to log in again when an API answers with an auth error
+        self.login_handler = None
+        # Logging in again is serialized, tokens replaced during this invocation are remembered. The lock is
+        # reentrant because the login requests themselves go through make_request
+        self.session_lock = threading.RLock()
+        self.renewing_session = False
+        self.expired_tokens = []
+        self.video_ids_file = os.path.join(settings_folder, 'video_ids')
+        self.watch_state = None
+        # Address of the addon service, cacheable and storage GETs are relayed through its warm session
+        self.relay_url = None
+        self.relay_session = requests.Session()
+        # Connect and read timeouts in seconds and how many times a failed GET is retried
+        self.timeout = (5, 20)
+        self.max_retries = 2
+        self.circuit = CircuitBreaker(os.path.join(settings_folder, 'circuits'))
+        self.tracer = Tracer(os.path.join(settings_folder, 'traces.jsonl'))
+        self.streams = StreamCache(os.path.join(settings_folder, 'streams'))
+        self.progress = ProgressQueue(os.path.join(settings_folder, 'progress_queue.db'))
+        self.progress_flush_lock = threading.Lock()
+        self.favorites = FavoritesMirror(os.path.join(settings_folder, 'favorites'))
+        self.catalog = Catalog(os.path.join(settings_folder, 'catalog.db'))
+        # Response bodies waiting to be indexed and the thread indexing them
+        self.index_queue = []
+        self.index_lock = threading.Lock()
+        self.index_task = None
 
     class RuutuError(Exception):
         def __init__(self, value):
@@ -38,49 +102,297 @@ class Ruutu(object):
         def __str__(self):
             return repr(self.value)
 
-    def log(self, string):
-        if self.debug:
-            try:
-                print '[Ruutu]: %s' % string
-            except UnicodeEncodeError:
-                # we can't anticipate everything in unicode they might throw at
-                # us, but we can handle a simple BOM
-                bom = unicode(codecs.BOM_UTF8, 'utf8')
-                print '[Ruutu]: %s' % string.replace(bom, '')
-            except:
-                pass
-
-    def make_request(self, url, method, params=None, payload=None, headers=None, text=False):
-        """Make an HTTP request. Return the response."""
-        self.log('Request URL: %s' % url)
-        self.log('Method: %s' % method)
-        self.log('Params: %s' % params)
-        self.log('Payload: %s' % payload)
-        self.log('Headers: %s' % headers)
+    def log(self, string, *args, **kwargs):
+        """Log string % args at kwargs['level'] (LOG_DEBUG by default). Formatting is skipped below log_level."""
+        level = kwargs.get('level', LOG_DEBUG)
+        if level < self.log_level:
+            return
         try:
-            if method == 'get':
-                req = self.http_session.get(url, params=params, headers=headers)
-            elif method == 'put':
-                req = self.http_session.put(url, params=params, data=payload, headers=headers)
-            elif method == 'delete':
-                req = self.http_session.delete(url, params=params, data=payload, headers=headers)
-            else:  # post
-                req = self.http_session.post(url, params=params, data=payload, headers=headers)
-            self.log('Response code: %s' % req.status_code)
-            self.log('Response: %s' % req.content)
-            self.cookie_jar.save(ignore_discard=True, ignore_expires=True)
+            if args:
+                string = string % args
+            string = SECRET_PATTERN.sub(r'\1***', string)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            pass
+
+        if self.log_handler:
+            self.log_handler(level, string)
+            return
+        try:
+            print '[Ruutu]: %s' % string
+        except UnicodeEncodeError:
+            # we can't anticipate everything in unicode they might throw at
+            # us, but we can handle a simple BOM
+            bom = unicode(codecs.BOM_UTF8, 'utf8')
+            print '[Ruutu]: %s' % string.replace(bom, '')
+        except:
+            pass
+
+    def log_body(self, body):
+        """Log a response body truncated to LOG_BODY_LIMIT."""
+        if self.log_level > LOG_DEBUG:
+            return
+        if len(body) > LOG_BODY_LIMIT:
+            self.log('Response: %s... (%s bytes)', body[:LOG_BODY_LIMIT], len(body))
+        else:
+            self.log('Response: %s', body)
+
+    def close(self):
+        """Persist state collected during the invocation, call once when done."""
+        self.cookie_jar.save_if_dirty()
+        self.wait_for_index()
+        summary = self.tracer.flush()
+        if summary:
+            self.log('Trace: %s', summary, level=LOG_INFO)
+
+    def make_request(self, url, method, params=None, payload=None, headers=None, text=False, index=False,
+                     status=False):
+        """Make an HTTP request. Return the response, with status (status code, response).
+
+        With index the grid items of a response that didn't come from the response cache are added to the
+        search catalog in the background. Cached and stale responses served on errors count as 200.
+        """
+        def result(body, status_code=200):
+            if text and not isinstance(body, unicode):
+                body = body.decode('utf-8')
+            return (status_code, body) if status else body
+
+        self.log('%s %s params: %s payload: %s headers: %s', method.upper(), url, params, payload, headers)
+
+        use_relay = self.relay_url and method == 'get' and headers is None and self.relayable(url)
+
+        # Cacheable GET requests are served from the response cache while fresh
+        ttl = self.cache.ttl_for(url) if method == 'get' else None
+        if ttl:
+            cache_key = self.cache.make_key(url, params)
+            cached = self.cache.get(cache_key)
+            if cached:
+                meta, body = cached
+                if self.cache.is_fresh(meta):
+                    self.log('Response from cache')
+                    self.tracer.count('cache_hits')
+                    return result(body)
+
+                # Stale entry, revalidate it
+                headers = dict(headers) if headers else {}
+                if meta.get('etag'):
+                    headers['If-None-Match'] = meta['etag']
+                if meta.get('last_modified'):
+                    headers['If-Modified-Since'] = meta['last_modified']
+        else:
+            cached = None
+
+        if use_relay:
+            # Only 200 responses come back from the service, anything else is requested directly
+            body = self.relay_request(url, params)
+            if body is not None:
+                self.tracer.count('relayed_requests')
+                self.raise_ruutu_error(body)
+                if ttl:
+                    self.cache.put(cache_key, url, body, ttl)
+                if index:
+                    self.index_later(body)
+                return result(body)
+
+        # Fail fast while the host is flapping, an old response is better than nothing
+        host = urlparse.urlparse(url).netloc
+        if not self.circuit.allow(host):
+            if cached:
+                self.log('%s is not responding, using a stale response', host, level=LOG_WARNING)
+                return result(cached[1])
+            raise self.RuutuError('%s is not responding, try again later' % host)
+
+        sent_token = self.credentials.token
+        try:
+            with self.tracer.span('http', endpoint=endpoint_name(url), method=method) as span:
+                req = self.send_request(url, method, params, payload, headers)
+                span.tag('status', req.status_code)
+                span.tag('bytes', len(req.content))
+                self.tracer.count('http_requests')
+                self.tracer.count('http_bytes', len(req.content))
+                # Time until the response headers were parsed, the rest of the span is the body download
+                span.tag('ttfb_ms', round(req.elapsed.total_seconds() * 1000, 1))
+
+            if req.status_code >= 500:
+                self.circuit.record_failure(host)
+                if cached:
+                    self.log('Server error %s, using a stale response', req.status_code, level=LOG_WARNING)
+                    return result(cached[1])
+            else:
+                self.circuit.record_success(host)
+
+            # Session token has expired, retry once with a new token
+            if req.status_code in (401, 403) and self.login_handler:
+                tokens = self.fresh_token(url, params, payload, sent_token)
+                if tokens:
+                    old_token, new_token = tokens
+                    url = self.replace_token(url, old_token, new_token)
+                    params = self.replace_token(params, old_token, new_token)
+                    payload = self.replace_token(payload, old_token, new_token)
+                    req = self.send_request(url, method, params, payload, headers)
+
+            self.log('Response code: %s', req.status_code)
+            self.log_body(req.content)
+
+            if cached and req.status_code == 304:
+                meta, body = cached
+                self.cache.refresh(cache_key, meta, body, ttl)
+                return result(body)
+
             self.raise_ruutu_error(req.content)
-            if text:
-                return req.text
-            return req.content
 
-        except requests.exceptions.ConnectionError as error:
-            self.log('Connection Error: - %s' % error.message)
+            # Don't let the service serve old history and favorites after a change
+            if method != 'get' and self.relay_url and url.startswith(STORAGE_URL):
+                self.relay_request(None)
+
+            if ttl and req.status_code == 200:
+                self.cache.put(cache_key, url, req.content, ttl, etag=req.headers.get('ETag'),
+                               last_modified=req.headers.get('Last-Modified'))
+            if index and req.status_code == 200:
+                self.index_later(req.content)
+
+            return result(req.text if text else req.content, req.status_code)
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+            self.log('Connection Error: - %s', error, level=LOG_ERROR)
+            self.circuit.record_failure(host)
+            if cached:
+                return result(cached[1])
             raise
         except requests.exceptions.RequestException as error:
-            self.log('Error: - %s' % error.value)
+            self.log('Error: - %s', error, level=LOG_ERROR)
             raise
 
+    def relayable(self, url):
+        """Whether the service may fetch url for the plugin, only cacheable and storage calls of Ruutu APIs."""
+        parsed = urlparse.urlparse(url)
+        if parsed.scheme != 'https' or not parsed.netloc.endswith('.nelonenmedia.fi'):
+            return False
+        return self.cache.ttl_for(url) is not None or url.startswith(STORAGE_URL)
+
+    def relay_request(self, url, params=None):
+        """Make a GET request through the addon service, url None drops what the service remembers.
+
+        Return the response body or None when the service can't be used or the API didn't answer 200.
+        """
+        if url is None:
+            relay_url = self.relay_url + '/invalidate'
+            relay_params = None
+        else:
+            relay_url = self.relay_url + '/fetch'
+            relay_params = {'url': requests.Request('GET', url, params=params).prepare().url}
+
+        try:
+            req = self.relay_session.get(relay_url, params=relay_params, timeout=(0.5, 60))
+        except requests.exceptions.RequestException as error:
+            self.log('Addon service not available: %s', error, level=LOG_WARNING)
+            self.relay_url = None
+            return None
+
+        if req.status_code != 200:
+            return None
+        return req.content
+
+    def send_request(self, url, method, params=None, payload=None, headers=None, stream=False):
+        """Send the request with timeouts. GET requests are retried with backoff on connection and server errors."""
+        if method != 'get':
+            if method == 'put':
+                return self.http_session.put(url, params=params, data=payload, headers=headers, timeout=self.timeout)
+            elif method == 'delete':
+                return self.http_session.delete(url, params=params, data=payload, headers=headers, timeout=self.timeout)
+            else:  # post
+                return self.http_session.post(url, params=params, data=payload, headers=headers, timeout=self.timeout)
+
+        attempt = 0
+        while True:
+            try:
+                req = self.http_session.get(url, params=params, headers=headers, timeout=self.timeout, stream=stream)
+                if req.status_code < 500 or attempt >= self.max_retries:
+                    return req
+                self.log('Server error %s, retrying', req.status_code, level=LOG_WARNING)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+                if attempt >= self.max_retries:
+                    raise
+                self.log('Connection Error: - %s, retrying', error, level=LOG_WARNING)
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+
+    def token_in_request(self, token, url, params, payload):
+        for value in (url, params, payload):
+            if isinstance(value, dict):
+                if token in value.values():
+                    return True
+            elif value and token in value:
+                return True
+        return False
+
+    def replace_token(self, value, old_token, new_token):
+        if isinstance(value, dict):
+            return dict((k, new_token if v == old_token else v) for k, v in value.items())
+        elif isinstance(value, basestring):
+            return value.replace(old_token, new_token)
+        return value
+
+    def fresh_token(self, url, params, payload, sent_token):
+        """Return (old_token, new_token) for a request rejected with an auth error or None if it can't be retried.
+
+        Only one thread logs in again. Requests that carry a token which has already been replaced, by another
+        thread or another invocation, are retried with the current token without a new login.
+        """
+        with self.session_lock:
+            # An auth error while logging in again is final
+            if self.renewing_session:
+                return None
+            current_token = self.credentials.token
+            candidates = [current_token, sent_token] + self.expired_tokens
+            old_token = next((token for token in candidates
+                              if token and self.token_in_request(token, url, params, payload)), None)
+            if not old_token:
+                return None
+            if current_token and old_token != current_token:
+                return old_token, current_token
+
+            new_token = self.renew_session()
+            if not new_token:
+                return None
+            self.expired_tokens.append(old_token)
+            return old_token, new_token
+
+    def renew_session(self):
+        """Log in again after an auth error. Return the new gatling token or None."""
+        credentials = dict(self.get_credentials())
+        if credentials.get('session_created'):
+            # Remember how long the token actually lived
+            credentials['session_lifetime'] = time.time() - credentials['session_created']
+        credentials['session_expires'] = 0
+        self.save_credentials(json.dumps(credentials))
+
+        self.log('Session expired, logging in again', level=LOG_INFO)
+        self.renewing_session = True
+        try:
+            self.login_handler()
+        except self.RuutuError as error:
+            self.log('Login failed: %s', error.value, level=LOG_ERROR)
+            return None
+        finally:
+            self.renewing_session = False
+
+        return self.credentials.token
+
+    def session_valid(self, username):
+        """Check without network requests whether the stored session can be used for username."""
+        credentials = self.get_credentials()
+        if not credentials.get('token') or credentials.get('username') != username:
+            return False
+        return credentials.get('session_expires', 0) > time.time()
+
+    def parse_json(self, body, url):
+        with self.tracer.span('json', endpoint=endpoint_name(url)):
+            return json.loads(body)
+
+    def parse_xml(self, body, url):
+        with self.tracer.span('xml', endpoint=endpoint_name(url)):
+            return xmltodict.parse(body)
+
     def raise_ruutu_error(self, response):
         try:
             response = json.loads(response)
@@ -102,25 +414,15 @@ class Ruutu(object):
             pass
 
     def save_credentials(self, credentials):
-        credentials_dict = json.loads(credentials)
-
-        with open(self.credentials_file, 'w') as fh_credentials:
-            fh_credentials.write(json.dumps(credentials_dict))
+        self.credentials.save(json.loads(credentials))
+        self.streams.clear()
 
     def reset_credentials(self):
-        credentials = {}
-        with open(self.credentials_file, 'w') as fh_credentials:
-            fh_credentials.write(json.dumps(credentials))
+        self.credentials.reset()
+        self.streams.clear()
 
     def get_credentials(self):
-        try:
-            with open(self.credentials_file, 'r') as fh_credentials:
-                credentials_dict = json.loads(fh_credentials.read())
-                return credentials_dict
-        except IOError:
-            self.reset_credentials()
-            with open(self.credentials_file, 'r') as fh_credentials:
-                return json.loads(fh_credentials.read())
+        return self.credentials.data
 
     def login(self, username=None, password=None):
         #https://prod-component-api.nm-services.nelonenmedia.fi/auth/init/login?widget=true&client=ruutu-prod&ref_url=https%3A%2F%2Fwww.ruutu.fi%2F&region=fi-FI&iframe=true
@@ -206,8 +508,15 @@ class Ruutu(object):
             access_token = self.get_tokens(code, state)['tokens']['access_token']
             gatling_token = self.create_session(access_token)['token']
 
+            session_lifetime = self.get_credentials().get('session_lifetime', SESSION_MAX_AGE)
+
             credentials = self.get_user_data(gatling_token)
+            credentials['username'] = username
+            credentials['session_created'] = time.time()
+            credentials['session_expires'] = time.time() + session_lifetime
+            credentials['session_lifetime'] = session_lifetime
             self.save_credentials(json.dumps(credentials))
+            self.cookie_jar.save_if_dirty()
 
         return True
 
@@ -251,11 +560,11 @@ class Ruutu(object):
 
     def get_page(self, url):
 
-        data = json.loads(self.make_request(url, 'get'))
+        data = self.parse_json(self.make_request(url, 'get'), url)
 
         return data
 
-    def get_page_json(self, page_type, page_id, userroles):
+    def get_page_json(self, page_type, page_id, userroles, index=True):
         url = 'https://prod-component-api.nm-services.nelonenmedia.fi/api/{page_type}/{page_id}'.format(page_type=page_type, page_id=page_id)
 
         params = {
@@ -264,21 +573,223 @@ class Ruutu(object):
             'userroles': userroles
         }
 
-        data = json.loads(self.make_request(url, 'get', params=params))
+        data = self.parse_json(self.make_request(url, 'get', params=params, index=index), url)
 
         return data
 
-    def get_grid_json(self, url, ruutu_params=None, offset=None, limit=None):
+    def get_grid_json(self, url, ruutu_params=None, offset=None, limit=None, index=True):
         params = json.loads(ruutu_params)
 
         if offset is not None and limit is not None:
             params['offset'] = offset
             params['limit'] = limit
 
-        data = json.loads(self.make_request(url, 'get', params=params))
+        data = self.parse_json(self.make_request(url, 'get', params=params, index=index), url)
 
         return data
 
+    def index(self, data):
+        """Add the grid items of a response to the local search catalog."""
+        with self.tracer.span('catalog') as span:
+            span.tag('items', self.catalog.add(data))
+
+    def index_later(self, body):
+        """Index a response body in a background thread, listings don't wait for SQLite."""
+        with self.index_lock:
+            self.index_queue.append(body)
+            if self.index_task is None:
+                self.index_task = Task(self.index_pending)
+
+    def index_pending(self):
+        while True:
+            with self.index_lock:
+                if not self.index_queue:
+                    self.index_task = None
+                    return
+                body = self.index_queue.pop(0)
+            try:
+                self.index(json.loads(body))
+            except (ValueError, AttributeError) as error:
+                self.log('Indexing a response failed: %s', error, level=LOG_WARNING)
+
+    def wait_for_index(self):
+        """Wait until the queued responses are indexed."""
+        while True:
+            with self.index_lock:
+                task = self.index_task
+            if task is None:
+                return
+            task.result()
+
+    def crawl_catalog(self, should_stop=lambda: False, page_size=100):
+        """Walk every page of the navigation and index all of their grids. Return how many grids were read."""
+        page_ids = []
+        for page in self.get_page(NAVIGATION_URL)['main']:
+            for child in page.get('children') or [page]:
+                if child.get('action') and child['action'].get('page_id'):
+                    page_ids.append(child['action']['page_id'])
+
+        grids = set()
+        for page_id in page_ids:
+            try:
+                page = self.get_page_json('page', page_id, self.credentials.role, index=False)
+                self.index(page)
+                components = page['components']
+            except (requests.exceptions.RequestException, self.RuutuError, KeyError) as error:
+                self.log('Crawling page %s failed: %s', page_id, error, level=LOG_WARNING)
+                continue
+            for component in components:
+                query = (component.get('content') or {}).get('query') or {}
+                params = query.get('params') or {}
+                # Grids of the user's own history and favorites aren't catalog content
+                if not query.get('url') or 'user_unfinished_videos' in params or 'user_favorite_series' in params:
+                    continue
+                grid = (query['url'], json.dumps(params, sort_keys=True))
+                if grid in grids:
+                    continue
+                grids.add(grid)
+                if should_stop():
+                    return len(grids)
+                try:
+                    # Cached windows are indexed too, the crawl keeps every item in the catalog fresh
+                    for items in self.iter_grid_windows(grid[0], grid[1], 0, page_size, max_workers=2,
+                                                        index=False):
+                        self.index({'items': items})
+                except (requests.exceptions.RequestException, self.RuutuError, KeyError) as error:
+                    self.log('Crawling grid %s failed: %s', grid[0], error, level=LOG_WARNING)
+
+        self.catalog.prune()
+        return len(grids)
+
+    def iter_grid_windows(self, url, ruutu_params, offset, limit, max_workers=6, index=True):
+        """Yield the items of consecutive offset/limit windows of a grid until it runs out.
+
+        The total isn't known beforehand, windows are fetched max_workers at a time and only one round is held
+        in memory.
+        """
+        while True:
+            offsets = [offset + i * limit for i in range(max_workers)]
+            pages = map_parallel(lambda window: self.get_grid_json(url, ruutu_params, offset=window, limit=limit,
+                                                                   index=index),
+                                 offsets, max_workers)
+            for page in pages:
+                if isinstance(page, Exception):
+                    raise page
+                yield page['items']
+                if len(page['items']) < limit:
+                    return
+            offset += max_workers * limit
+
+    def resolve_video_ids(self, targets, userroles, max_workers=6):
+        """Resolve (target_type, target_id) pairs of channel_id and stream_id items to video ids.
+
+        Pages are fetched concurrently, return a dict keyed by the pair. Targets that can't be resolved are left out.
+        """
+        now = time.time()
+        known = self.load_video_ids(now)
+
+        def cache_key(target):
+            return '%s:%s:%s' % (target[0], target[1], userroles)
+
+        video_ids = {}
+        missing = []
+        for target in set(targets):
+            if cache_key(target) in known:
+                video_ids[target] = known[cache_key(target)][0]
+            else:
+                missing.append(target)
+
+        def resolve(target):
+            target_type, target_id = target
+            if target_type == 'channel_id':
+                page = self.get_page_json('channel', target_id, userroles)
+                return page['components'][0]['content']['items'][0]['content']['items'][0]['video_id']
+            else:  # stream_id
+                page = self.get_page_json('stream', target_id, userroles)
+                return page['components'][0]['content']['items'][0]['video_id']
+
+        resolved = {}
+        for target, video_id in zip(missing, map_parallel(resolve, missing, max_workers)):
+            if isinstance(video_id, Exception):
+                self.log('Could not resolve video id for %s %s: %s', target[0], target[1], video_id, level=LOG_WARNING)
+                continue
+            video_ids[target] = video_id
+            resolved[cache_key(target)] = [video_id, now + VIDEO_ID_TTL]
+
+        if resolved:
+            # Merge with what other invocations stored while the pages were fetched
+            known = self.load_video_ids(now)
+            known.update(resolved)
+            try:
+                atomic_write(self.video_ids_file, json.dumps(known))
+            except (IOError, OSError) as error:
+                self.log('Could not save video ids: %s', error, level=LOG_WARNING)
+
+        return video_ids
+
+    def load_video_ids(self, now):
+        """Unexpired video id mappings from the profile folder."""
+        try:
+            with open(self.video_ids_file, 'r') as fh_video_ids:
+                known = json.loads(fh_video_ids.read())
+        except (IOError, ValueError):
+            return {}
+        return dict((k, v) for k, v in known.items() if v[1] > now)
+
+    def get_watch_state(self):
+        """Return the WatchState of the logged in user, history and favorites are fetched once per instance."""
+        if self.watch_state is None:
+            account_id = self.credentials.account_id
+            if account_id:
+                token = self.credentials.token
+                # Favorites come from the local mirror, a stale mirror is refreshed without waiting for it
+                synced = self.favorites.synced(account_id)
+                if not synced or self.favorites.is_stale(account_id):
+                    sync = Task(self.sync_favorites)
+                history = self.get_page('https://gatling.nelonenmedia.fi/storage/history?unfinished=true&gatling_token=' + token)
+                if not synced:
+                    sync.result()
+                self.watch_state = WatchState(history, self.favorites.items(account_id))
+            else:
+                self.watch_state = WatchState()
+        return self.watch_state
+
+    def get_history_state(self):
+        """Return a WatchState with only the watch history, for resume points where favorites aren't needed."""
+        if self.watch_state is not None:
+            return self.watch_state
+        if not self.credentials.account_id:
+            return WatchState()
+        history = self.get_page(STORAGE_URL + 'history?unfinished=true&gatling_token=' + self.credentials.token)
+        return WatchState(history)
+
+    def set_favorite(self, series_id, favorite):
+        """Add or remove a favorite in the local mirror, sync_favorites() sends it to Ruutu."""
+        self.favorites.set_favorite(self.credentials.account_id, series_id, favorite)
+        self.watch_state = None
+
+    def sync_favorites(self):
+        """Send pending favorite changes and fetch the favorites from Ruutu.
+
+        Changes that fail to send stay pending and keep overriding the server copy until a later sync.
+        """
+        account_id = self.credentials.account_id
+        if not account_id:
+            return
+        for series_id, change in self.favorites.pending(account_id).items():
+            try:
+                if change == ADD:
+                    self.add_favorite(series_id, self.credentials.token)
+                else:
+                    self.remove_favorite(series_id, self.credentials.token)
+            except (requests.exceptions.RequestException, self.RuutuError) as error:
+                self.log('Syncing favorite %s failed: %s', series_id, error, level=LOG_WARNING)
+            else:
+                self.favorites.sent(account_id, series_id, change)
+
+        items = self.get_page(STORAGE_URL + 'favorite?gatling_token=' + self.credentials.token)
+        self.favorites.replace(account_id, items)
+
     def add_favorite(self, series_id, gatling_token):
         url = 'https://gatling.nelonenmedia.fi/storage/favorite'
 
@@ -288,6 +799,8 @@ class Ruutu(object):
             'item': series_id
         }
 
+        self.watch_state = None
+
         return self.make_request(url, 'post', params=None, payload=payload, headers=None)
 
     def remove_favorite(self, series_id, gatling_token):
@@ -299,6 +812,8 @@ class Ruutu(object):
             'item': series_id
         }
 
+        self.watch_state = None
+
         return self.make_request(url, 'delete', params=None, payload=payload, headers=None)
 
     def update_unfinished(self, video_id, time, gatling_token):
@@ -311,6 +826,8 @@ class Ruutu(object):
             'gatling_token': gatling_token
         }
 
+        self.watch_state = None
+
         return self.make_request(url, 'post', params=None, payload=payload, headers=None)
 
     def update_finished(self, video_id, gatling_token):
@@ -323,8 +840,37 @@ class Ruutu(object):
             'gatling_token': gatling_token
         }
 
+        self.watch_state = None
+
         return self.make_request(url, 'delete', params=None, payload=payload, headers=None)
 
+    def flush_progress(self):
+        """Send queued playback progress, failed updates are retried later with backoff.
+
+        Only progress of the logged in account is sent, return True when none of it is left in the queue.
+        """
+        # One flush at a time, a second call waits and then sends what the first one didn't see
+        with self.progress_flush_lock:
+            token = self.credentials.token
+            account_id = self.credentials.account_id
+            if not token or not account_id:
+                return False
+            for video_id, position, finished, updated, attempts in self.progress.pending(account_id):
+                try:
+                    if finished:
+                        self.update_finished(video_id, token)
+                    else:
+                        self.update_unfinished(video_id, format(position, '.2f'), token)
+                except (requests.exceptions.RequestException, self.RuutuError) as error:
+                    self.log('Sending progress of %s failed: %s', video_id, error, level=LOG_WARNING)
+                    self.progress.retry_later(account_id, video_id, updated, attempts + 1,
+                                              backoff_delay(attempts, base=30, cap=60 * 60))
+                else:
+                    self.progress.remove(account_id, video_id, updated)
+                # The token may have been renewed by the request
+                token = self.credentials.token
+            return self.progress.count(account_id) == 0
+
     def get_next_episode_id(self, video_id):
         url = 'https://gatling.nelonenmedia.fi/recommend'
 
@@ -333,7 +879,7 @@ class Ruutu(object):
             'id': video_id
         }
 
-        data = json.loads(self.make_request(url, 'get', params=params))
+        data = self.parse_json(self.make_request(url, 'get', params=params), url)
 
         return data
 
@@ -345,16 +891,38 @@ class Ruutu(object):
             'id': video_id
         }
 
-        data = json.loads(self.make_request(url, 'get', params=params))
+        data = self.parse_json(self.make_request(url, 'get', params=params), url)
 
         return data
 
     def get_stream(self, video_id, type):
+        """Return the stream descriptor of video_id, resolved videos are reused until their token expires."""
+        # Live streams are cheap to resolve and the channel may point to another video next time
+        if type == 'live':
+            return self.resolve_stream(video_id, type)
+
+        role = self.credentials.role
+        stream = self.streams.get(video_id, role)
+        if stream:
+            self.log('Stream of %s from cache', video_id)
+            self.tracer.count('stream_cache_hits')
+            return stream
+
+        stream = self.resolve_stream(video_id, type)
+        # A DRM stream without a license URL can't be played, resolve it again next time
+        if not stream['drm_protected'] or stream.get('license_url'):
+            self.streams.put(video_id, role, stream)
+        return stream
+
+    def invalidate_stream(self, video_id):
+        self.streams.invalidate(video_id)
+
+    def resolve_stream(self, video_id, type):
         stream = {}
 
         url = 'https://gatling.nelonenmedia.fi/media-xml-cache?id={video_id}&v=2'.format(video_id=video_id)
 
-        media_xml = xmltodict.parse(self.make_request(url, 'get', headers=None))
+        media_xml = self.parse_xml(self.make_request(url, 'get', headers=None), url)
 
         if type == 'live':
             stream_auth_url = 'https://gatling.nelonenmedia.fi/auth/access/v2'
@@ -362,7 +930,7 @@ class Ruutu(object):
             stream_auth_params = {
                 'stream': media_xml['Playerdata']['Clip']['AppleMediaFiles']['AppleMediaFile'],
                 'timestamp': '1546978227167',
-                'gatling_token': self.get_credentials()['token']
+                'gatling_token': self.credentials.token
             }
 
             stream_auth_m3u8 = self.make_request(stream_auth_url, 'get', params=stream_auth_params)
@@ -390,18 +958,15 @@ class Ruutu(object):
             }
 
             # If user is logged in add gatling_token to params, this is needed for playing drm protected Ruutu+ videos
-            if self.get_credentials().get('accountId'):
-                params['gatling_token'] = self.get_credentials()['token']
+            if self.credentials.account_id:
+                params['gatling_token'] = self.credentials.token
 
-            drm_json = json.loads(self.make_request(drm_check_url, 'get', params=params))
+            drm_json = self.parse_json(self.make_request(drm_check_url, 'get', params=params), drm_check_url)
 
             stream['drm_token'] = urllib.quote_plus(drm_json['empDrmKey']['playToken'])
             stream['video_url'] = 'https:' + drm_json['empDrmKey']['mediaLocator']
 
-            mpd_playlist = xmltodict.parse(self.make_request(stream['video_url'], 'get'))
-
-            if mpd_playlist['MPD']['Period']['@id'] == 'P0':
-                stream['license_url'] = mpd_playlist['MPD']['Period']['AdaptationSet'][0]['ContentProtection'][1]['ms:laurl']['@licenseUrl']
+            stream['license_url'] = self.get_license_url(stream['video_url'])
 
         else:
             stream['drm_protected'] = False
@@ -418,6 +983,36 @@ class Ruutu(object):
 
         return stream
 
+    def get_license_url(self, mpd_url):
+        """Read the DASH manifest only until its PlayReady license URL shows up."""
+        host = urlparse.urlparse(mpd_url).netloc
+        if not self.circuit.allow(host):
+            raise self.RuutuError('%s is not responding, try again later' % host)
+
+        with self.tracer.span('http', endpoint=endpoint_name(mpd_url), method='get') as span:
+            try:
+                req = self.send_request(mpd_url, 'get', stream=True)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self.circuit.record_failure(host)
+                raise
+            span.tag('status', req.status_code)
+            self.tracer.count('http_requests')
+            if req.status_code >= 500:
+                self.circuit.record_failure(host)
+            else:
+                self.circuit.record_success(host)
+            if req.status_code != 200:
+                req.close()
+                raise self.RuutuError('Manifest request failed with status %s' % req.status_code)
+            try:
+                with self.tracer.span('xml', endpoint=endpoint_name(mpd_url)):
+                    license_url = find_license_url(req.iter_content(16 * 1024))
+            finally:
+                req.close()
+
+        self.log('License URL: %s', license_url)
+        return license_url
+
     def unix_to_datetime(self, unix_timestamp):
         local_time = datetime.fromtimestamp(unix_timestamp)
 
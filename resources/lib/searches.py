@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Recent search terms
+"""
+import re
+import json
+
+from fileutil import atomic_write
+
+SPACE_PATTERN = re.compile(r'\s+', re.UNICODE)
+
+
+def normalize_term(term):
+    """Lower case term with single spaces as an UTF-8 string, equal searches map to the same term and cache key."""
+    if not isinstance(term, unicode):
+        term = term.decode('utf-8')
+    return SPACE_PATTERN.sub(u' ', term).strip().lower().encode('utf-8')
+
+
+class SearchHistory(object):
+    """Most recent first list of normalized search terms, kept in the profile folder."""
+
+    def __init__(self, history_file, max_terms=20):
+        self.history_file = history_file
+        self.max_terms = max_terms
+
+    def terms(self):
+        try:
+            with open(self.history_file, 'r') as fh_history:
+                return [term.encode('utf-8') for term in json.loads(fh_history.read())]
+        except (IOError, ValueError, AttributeError):
+            return []
+
+    def add(self, term):
+        terms = [term] + [x for x in self.terms() if x != term]
+        self._save(terms[:self.max_terms])
+
+    def remove(self, term):
+        self._save([x for x in self.terms() if x != term])
+
+    def _save(self, terms):
+        try:
+            atomic_write(self.history_file, json.dumps([term.decode('utf-8') for term in terms]))
+        except (IOError, OSError):
+            pass
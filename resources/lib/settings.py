@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Per-invocation snapshot of addon settings and localized strings
+"""
+import xml.etree.ElementTree as ET
+
+
+class Settings(object):
+    """Reads every setting declared in settings.xml once and coerces it to its declared type."""
+
+    def __init__(self, addon, settings_xml):
+        self._values = {}
+        self._types = {}
+        for setting in ET.parse(settings_xml).iter('setting'):
+            setting_id = setting.get('id')
+            setting_type = setting.get('type')
+            if not setting_id or setting_type == 'action':
+                continue
+            self._types[setting_id] = setting_type
+            self._values[setting_id] = self._coerce(setting_type, addon.getSetting(setting_id), setting.get('default'))
+
+    def _coerce(self, setting_type, value, default=None):
+        if setting_type == 'bool':
+            return value == 'true'
+        elif setting_type in ('number', 'enum', 'slider'):
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                try:
+                    return int(default)
+                except (TypeError, ValueError):
+                    return 0
+        return value
+
+    def __getattr__(self, setting_id):
+        try:
+            return self.__dict__['_values'][setting_id]
+        except KeyError:
+            raise AttributeError(setting_id)
+
+    def get(self, setting_id):
+        return self._values.get(setting_id)
+
+    def update(self, setting_id, value):
+        self._values[setting_id] = self._coerce(self._types.get(setting_id), value)
+
+
+class LocalizedStrings(object):
+    """Memoized getLocalizedString, call it like the original."""
+
+    def __init__(self, addon):
+        self.get_localized_string = addon.getLocalizedString
+        self._strings = {}
+
+    def __call__(self, string_id):
+        if string_id not in self._strings:
+            self._strings[string_id] = self.get_localized_string(string_id)
+        return self._strings[string_id]
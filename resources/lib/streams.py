@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Resolved stream descriptors that can be played again without the pre-roll requests
+"""
+import re
+import json
+import time
+import base64
+import urllib
+import urlparse
+import threading
+
+from fileutil import atomic_write
+
+# Expiry timestamps inside signed URLs: Akamai style exp=... tokens and plain expires parameters
+EXPIRY_PATTERN = re.compile(r'(?:^|[~&?])(?:exp|expires|Expires)=(\d{10})')
+
+
+def jwt_expiry(token):
+    """Expiry of a JWT or None when token isn't one."""
+    parts = token.split('.')
+    if len(parts) != 3:
+        return None
+    payload = parts[1] + '=' * (-len(parts[1]) % 4)
+    try:
+        return int(json.loads(base64.urlsafe_b64decode(payload.encode('ascii')))['exp'])
+    except (TypeError, ValueError, KeyError, UnicodeError):
+        return None
+
+
+def stream_expiry(stream):
+    """Earliest expiry found in the signed video URL or DRM token of stream, None when nothing is known."""
+    expiries = []
+    video_url = urllib.unquote(stream.get('video_url') or '')
+    expiries.extend(int(value) for value in EXPIRY_PATTERN.findall(urlparse.urlparse(video_url).query))
+    if stream.get('drm_token'):
+        expiry = jwt_expiry(urllib.unquote_plus(stream['drm_token']))
+        if expiry:
+            expiries.append(expiry)
+    return min(expiries) if expiries else None
+
+
+class StreamCache(object):
+    """Stream descriptors keyed by video_id and user role, kept in the profile folder.
+
+    An entry lives until the earliest expiry of its signed URL or token minus margin, or default_ttl when the
+    stream doesn't tell. max_ttl caps both because a token can be revoked before it expires.
+    """
+
+    def __init__(self, cache_file, default_ttl=10 * 60, max_ttl=60 * 60, margin=60):
+        self.cache_file = cache_file
+        self.default_ttl = default_ttl
+        self.max_ttl = max_ttl
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.entries = self._load()
+
+    def make_key(self, video_id, role):
+        return '%s:%s' % (video_id, role)
+
+    def get(self, video_id, role):
+        with self.lock:
+            entry = self.entries.get(self.make_key(video_id, role))
+        if entry and entry['expires'] > time.time():
+            return entry['stream']
+        return None
+
+    def put(self, video_id, role, stream):
+        now = time.time()
+        expires = min(now + self.max_ttl, (stream_expiry(stream) or now + self.default_ttl + self.margin) - self.margin)
+        if expires <= now:
+            return
+        with self.lock:
+            # Start from the file so entries other invocations added or invalidated meanwhile are kept that way,
+            # expired entries are dropped whenever something is added
+            self.entries = dict((key, entry) for key, entry in self._load().items() if entry['expires'] > now)
+            self.entries[self.make_key(video_id, role)] = {'stream': stream, 'expires': expires}
+            self._save()
+
+    def invalidate(self, video_id):
+        """Forget the streams of video_id for every role, e.g. after it failed to play."""
+        prefix = '%s:' % video_id
+        with self.lock:
+            self.entries = self._load()
+            keys = [key for key in self.entries if key.startswith(prefix)]
+            for key in keys:
+                del self.entries[key]
+            if keys:
+                self._save()
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self._save()
+
+    def _load(self):
+        try:
+            with open(self.cache_file, 'r') as fh_streams:
+                return json.loads(fh_streams.read())
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self):
+        try:
+            atomic_write(self.cache_file, json.dumps(self.entries))
+        except (IOError, OSError):
+            pass
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Ruutu+ sticker thumbnails and downscaled artwork, cached by source image URL
+"""
+import os
+import time
+import hashlib
+import threading
+from StringIO import StringIO
+
+from PIL import Image
+
+from workers import map_parallel
+from fileutil import atomic_write
+from tracing import Tracer
+
+
+class ThumbnailCache(object):
+    def __init__(self, folder, sticker_path, fetch, max_size=50 * 1024 * 1024, max_age=30 * 24 * 60 * 60, tracer=None):
+        """fetch is called with an image URL and returns the image bytes."""
+        self.folder = folder
+        self.tracer = tracer or Tracer()
+        self.sticker_path = sticker_path
+        self.fetch = fetch
+        self.max_size = max_size
+        self.max_age = max_age
+        self._sticker = None
+        self._sticker_lock = threading.Lock()
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+    @property
+    def sticker(self):
+        with self._sticker_lock:
+            if self._sticker is None:
+                sticker = Image.open(self.sticker_path)
+                sticker.load()
+                self._sticker = sticker
+        return self._sticker
+
+    def path_for(self, url, sticker=True, width=None):
+        key = '%s|%s|%s' % (url.encode('utf-8') if isinstance(url, unicode) else url, int(sticker), width or '')
+        extension = '.png' if sticker else '.jpg'
+        return os.path.join(self.folder, hashlib.sha1(key).hexdigest() + extension)
+
+    def get(self, url, sticker=True, width=None):
+        """Return the path of the processed image, creating it first if it isn't cached yet."""
+        path = self.path_for(url, sticker, width)
+        if os.path.exists(path):
+            return path
+        return self.create(url, sticker, width)
+
+    def create(self, url, sticker=True, width=None):
+        path = self.path_for(url, sticker, width)
+        data = self.fetch(url)
+
+        output = StringIO()
+        with self.tracer.span('pil', sticker=sticker, width=width):
+            image = Image.open(StringIO(data))
+
+            if width and image.size[0] > width:
+                height = int(image.size[1] * width / float(image.size[0]))
+                image = image.resize((width, height), Image.ANTIALIAS)
+
+            if sticker:
+                image.paste(self.sticker, (5, 5), self.sticker)
+                image.save(output, 'PNG')
+            else:
+                image.convert('RGB').save(output, 'JPEG', quality=90)
+        atomic_write(path, output.getvalue())
+        return path
+
+    def prepare(self, urls, max_workers=4):
+        """Composite every missing thumb of urls in parallel."""
+        missing = [url for url in set(urls) if not os.path.exists(self.path_for(url))]
+        map_parallel(self.create, missing, max_workers)
+        self.cleanup()
+
+    def cleanup(self, interval=60 * 60):
+        """Drop thumbs older than max_age and the oldest ones above max_size, at most once per interval."""
+        marker = os.path.join(self.folder, '.cleanup')
+        try:
+            if time.time() - os.path.getmtime(marker) < interval:
+                return
+        except OSError:
+            pass
+        open(marker, 'w').close()
+
+        now = time.time()
+        entries = []
+        total_size = 0
+        for filename in os.listdir(self.folder):
+            path = os.path.join(self.folder, filename)
+            if path == marker:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.max_age:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight per-invocation timing spans
+"""
+import os
+import re
+import json
+import time
+import threading
+import urlparse
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Numeric path segments are folded so that spans of the same endpoint group together
+ID_PATTERN = re.compile(r'/\d+')
+
+
+def endpoint_name(url):
+    parsed = urlparse.urlparse(url)
+    return parsed.netloc + ID_PATTERN.sub('/{id}', parsed.path)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+class Span(object):
+    def __init__(self, tracer, name, tags):
+        self.tracer = tracer
+        self.name = name
+        self.tags = tags
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def tag(self, key, value):
+        self.tags[key] = value
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        span = dict(self.tags)
+        span['name'] = self.name
+        span['ms'] = round((time.time() - self.start) * 1000, 1)
+        if exc_type:
+            span['error'] = exc_type.__name__
+        self.tracer.record(span)
+        return False
+
+
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def tag(self, key, value):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer(object):
+    """Collects timed spans of one invocation. Disabled tracers hand out a shared no-op span."""
+
+    def __init__(self, trace_file=None, enabled=False, max_size=1024 * 1024):
+        self.trace_file = trace_file
+        self.enabled = enabled
+        self.max_size = max_size
+        self.action = None
+        self.started = time.time()
+        self.spans = []
+        self.counters = {}
+        self.counters_lock = threading.Lock()
+
+    def count(self, counter, amount=1):
+        """Add to a per-invocation counter such as HTTP requests or bytes transferred."""
+        with self.counters_lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def peak_memory(self):
+        """Peak resident memory of the process in kilobytes or None where it can't be read."""
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS reports bytes, Linux kilobytes
+        return peak // 1024 if os.uname()[0] == 'Darwin' else peak
+
+    def span(self, name, **tags):
+        """Use as a context manager, more tags can be added with span.tag() inside the block."""
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, tags)
+
+    def record(self, span):
+        span['action'] = self.action
+        self.spans.append(span)
+
+    def summary(self):
+        """One line per span name: count and total milliseconds."""
+        totals = {}
+        for span in self.spans:
+            count, ms = totals.get(span['name'], (0, 0))
+            totals[span['name']] = (count + 1, ms + span['ms'])
+        parts = ['%s %sx %.0fms' % (name, count, ms) for name, (count, ms) in sorted(totals.items())]
+        parts.extend('%s %s' % (counter, value) for counter, value in sorted(self.counters.items()))
+        return 'action %s took %.0fms: %s' % (self.action, (time.time() - self.started) * 1000, ', '.join(parts))
+
+    def flush(self):
+        """Append the spans of the invocation to the trace file. Return the summary or None when disabled.
+
+        Counters and the start time are reset, in the long-lived service every flush covers the work since the last.
+        """
+        if not self.enabled:
+            self.reset()
+            return None
+
+        invocation = dict(self.counters)
+        invocation['name'] = 'invocation'
+        invocation['ms'] = round((time.time() - self.started) * 1000, 1)
+        invocation['peak_kb'] = self.peak_memory()
+        self.record(invocation)
+        summary = self.summary()
+        spans = self.spans
+        self.spans = []
+        self.reset()
+        if self.trace_file:
+            try:
+                self._rotate()
+                with open(self.trace_file, 'a') as fh_trace:
+                    for span in spans:
+                        fh_trace.write(json.dumps(span) + '\n')
+            except (IOError, OSError):
+                pass
+        return summary
+
+    def reset(self):
+        with self.counters_lock:
+            self.counters = {}
+        self.started = time.time()
+
+    def _rotate(self):
+        # Keep the newer half when the file has grown too big
+        if not os.path.exists(self.trace_file) or os.path.getsize(self.trace_file) < self.max_size:
+            return
+        with open(self.trace_file, 'r') as fh_trace:
+            lines = fh_trace.readlines()
+        with open(self.trace_file, 'w') as fh_trace:
+            fh_trace.writelines(lines[len(lines) // 2:])
+
+    def statistics(self):
+        """Return [(name, key, count, p50, p95)] of durations from the trace file, keyed by endpoint or action.
+
+        Invocations also get rows for their counters and peak memory, named invocation.<counter>.
+        """
+        durations = {}
+        try:
+            with open(self.trace_file, 'r') as fh_trace:
+                for line in fh_trace:
+                    try:
+                        span = json.loads(line)
+                    except ValueError:
+                        continue
+                    key = (span['name'], span.get('endpoint') or span.get('action'))
+                    durations.setdefault(key, []).append(span['ms'])
+                    if span['name'] == 'invocation':
+                        for counter, value in span.items():
+                            if counter not in ('name', 'ms', 'action') and value is not None:
+                                durations.setdefault(('invocation.' + counter, span.get('action')), []).append(value)
+        except (IOError, OSError, TypeError):
+            return []
+
+        return [(name, key, len(values), percentile(values, 50), percentile(values, 95))
+                for (name, key), values in sorted(durations.items())]
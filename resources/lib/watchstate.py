@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Index of the user's Ruutu watch history and favorites
+"""
+
+
+class WatchState(object):
+    """Built once per invocation from gatling storage/history and storage/favorite responses."""
+
+    def __init__(self, history=None, favorites=None):
+        self.history = list(history or [])
+        self.favorites = list(favorites or [])
+        self._history = dict((str(x['video']), x) for x in self.history)
+        self._favorites = set(str(x['item']) for x in self.favorites)
+
+    def entry(self, video_id):
+        return self._history.get(str(video_id))
+
+    def resume_info(self, video_id, duration):
+        """Return (playcount, resume, total) of a video. playcount is None for partly watched videos."""
+        entry = self.entry(video_id)
+        if entry is None:  # Unwatched video
+            return 0, 0, 1
+        if entry['unfinished'] is False:  # Watched video
+            return 1, 0, duration
+        if entry['watched'] is None:  # Unwatched video
+            return 0, 0, 1
+        return None, entry['watched'], duration  # Partly watched
+
+    def is_favorite(self, item_id):
+        return str(item_id) in self._favorites
+
+    def unfinished_videos(self):
+        """Comma separated ids for the user_unfinished_videos grid parameter."""
+        # Remove watched videos from list
+        return ''.join(',' + str(x['video']) for x in self.history if x['unfinished'] is True)
+
+    def favorite_series(self):
+        """Comma separated ids for the user_favorite_series grid parameter."""
+        # Show only Ruutu favorites
+        return ''.join(',' + str(x['item']) for x in self.favorites if x['type'] == 'series')
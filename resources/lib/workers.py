@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Small thread helpers, Kodi's Python doesn't ship concurrent.futures
+"""
+import sys
+import threading
+from Queue import Queue, Empty
+
+
+class Task(object):
+    """Runs func(*args, **kwargs) in a daemon thread, result() waits for it and re-raises errors."""
+
+    def __init__(self, func, *args, **kwargs):
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(func, args, kwargs))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, args, kwargs):
+        try:
+            self._result = func(*args, **kwargs)
+        except Exception:
+            self._error = sys.exc_info()
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def result(self, timeout=None):
+        self._thread.join(timeout)
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+
+def map_parallel(func, items, max_workers=6):
+    """Call func for every item using at most max_workers threads. Return the results in input order.
+
+    A failing call doesn't stop the others, its result is the raised exception instance.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    if not items:
+        return results
+
+    queue = Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception as error:
+                results[index] = error
+
+    threads = [threading.Thread(target=worker) for _ in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
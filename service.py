@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import socket
+import threading
+
+import xbmc
+import xbmcgui
+from xbmcaddon import Addon
+
+from resources.lib.ruutu import Ruutu, STORAGE_URL, NAVIGATION_URL
+from resources.lib.thumbnails import ThumbnailCache
+from resources.lib.localserver import LocalServer
+from resources.lib.kodihelper import SERVICE_PROPERTY, SERVICE_ENDPOINTS_PROPERTY, configure_ruutu
+from resources.lib.settings import Settings
+from resources.lib.workers import Task
+
+# How often the catalog is prefetched and how long relayed history and favorites are remembered
+PREFETCH_INTERVAL = 5 * 60
+STORAGE_TTL = 60
+
+# How often playback progress and favorite changes left behind by plugin invocations are sent
+PROGRESS_INTERVAL = 60
+
+# How often the search catalog is rebuilt from the navigation tree, the first crawl waits this long after start
+CATALOG_CRAWL_INTERVAL = 24 * 60 * 60
+CATALOG_CRAWL_DELAY = 10 * 60
+
+class ServiceRelay(object):
+    """Answers relayed plugin requests with the service's long-lived Ruutu client."""
+
+    def __init__(self, ruutu):
+        self.r = ruutu
+        self.storage = {}
+        self.lock = threading.Lock()
+
+    def relayable(self, url):
+        return self.r.relayable(url)
+
+    def fetch(self, url):
+        """Return (status code, response body)."""
+        # Response cache of the client handles everything but user specific storage calls
+        if not url.startswith(STORAGE_URL):
+            return self.r.make_request(url, 'get', status=True)
+
+        with self.lock:
+            cached = self.storage.get(url)
+        if cached and cached[1] > time.time():
+            return 200, cached[0]
+
+        status_code, body = self.r.make_request(url, 'get', status=True)
+        if status_code == 200:
+            with self.lock:
+                self.storage[url] = (body, time.time() + STORAGE_TTL)
+        return status_code, body
+
+    def invalidate(self):
+        with self.lock:
+            self.storage = {}
+
+    def prefetch(self):
+        """Warm navigation, front page, history and favorites so plugin invocations find them ready."""
+        self.r.get_page(NAVIGATION_URL)
+        self.r.get_page_json('page', 200, self.r.credentials.role)
+
+        if self.r.credentials.account_id:
+            # Favorite changes are sent first so the relayed storage responses include them
+            self.r.sync_favorites()
+            self.invalidate()
+            self.fetch(STORAGE_URL + 'history?unfinished=true&gatling_token=' + self.r.credentials.token)
+
+class RuutuService(xbmc.Monitor):
+    def __init__(self):
+        xbmc.Monitor.__init__(self)
+        addon = Addon()
+        self.addon = addon
+        self.addon_path = xbmc.translatePath(addon.getAddonInfo('path'))
+        self.addon_profile = xbmc.translatePath(addon.getAddonInfo('profile'))
+        self.logging_prefix = '[%s-%s-service]' % (addon.getAddonInfo('id'), addon.getAddonInfo('version'))
+        self.settings = self.read_settings()
+        self.r = Ruutu(self.addon_profile)
+        configure_ruutu(self.r, self.settings, self.logging_prefix)
+        self.r.tracer.action = 'service'
+        self.relay = ServiceRelay(self.r)
+        self.server = None
+        self.crawl_task = None
+
+    def log(self, string):
+        msg = '%s: %s' % (self.logging_prefix, string)
+        xbmc.log(msg=msg, level=xbmc.LOGDEBUG)
+
+    def read_settings(self):
+        # A new Addon instance, the old one keeps returning the values it had when it was created
+        return Settings(Addon(), os.path.join(self.addon_path, 'resources', 'settings.xml'))
+
+    def server_settings(self):
+        return self.settings.use_service, self.settings.image_proxy, self.settings.service_port
+
+    def onSettingsChanged(self):
+        old_server_settings = self.server_settings()
+        self.settings = self.read_settings()
+        configure_ruutu(self.r, self.settings, self.logging_prefix)
+        if self.server_settings() != old_server_settings:
+            self.log('Server settings changed, restarting local server')
+            self.stop_server()
+            self.start_server()
+
+    def start_server(self):
+        use_service, image_proxy, port = self.server_settings()
+        if not use_service and not image_proxy:
+            return
+
+        thumbnails = ThumbnailCache(self.r.tempdir, os.path.join(self.addon_path, 'resources', 'sticker.png'),
+                                    lambda url: self.r.make_request(url, 'get'))
+        try:
+            self.server = LocalServer(thumbnails=thumbnails if image_proxy else None,
+                                      relay=self.relay if use_service else None,
+                                      port=port, log=self.log)
+        except (socket.error, ValueError) as error:
+            self.log('Could not start local server: %s' % error)
+            return
+
+        self.server.start()
+        endpoints = [name for name, enabled in (('image', image_proxy), ('fetch', use_service)) if enabled]
+        xbmcgui.Window(10000).setProperty(SERVICE_ENDPOINTS_PROPERTY, ','.join(endpoints))
+        xbmcgui.Window(10000).setProperty(SERVICE_PROPERTY, self.server.url)
+        self.log('Local server running at %s' % self.server.url)
+
+    def stop_server(self):
+        if self.server:
+            xbmcgui.Window(10000).clearProperty(SERVICE_PROPERTY)
+            xbmcgui.Window(10000).clearProperty(SERVICE_ENDPOINTS_PROPERTY)
+            self.server.stop()
+            self.server = None
+
+    def prefetch(self):
+        try:
+            self.relay.prefetch()
+        except Exception as error:
+            self.log('Prefetch failed: %s' % error)
+        self.r.close()
+
+    def flush_progress(self):
+        account_id = self.r.credentials.account_id
+        changes = account_id and (self.r.progress.count(account_id) or self.r.favorites.pending(account_id))
+        try:
+            self.r.flush_progress()
+            if account_id and self.r.favorites.pending(account_id):
+                self.r.sync_favorites()
+        except Exception as error:
+            self.log('Sending playback progress or favorites failed: %s' % error)
+        # Relayed history and favorites don't include what was just sent
+        if changes:
+            self.relay.invalidate()
+        self.r.close()
+
+    def crawl_catalog(self):
+        try:
+            grids = self.r.crawl_catalog(should_stop=self.abortRequested)
+            self.log('Catalog crawl read %s grids' % grids)
+        except Exception as error:
+            self.log('Catalog crawl failed: %s' % error)
+        self.r.close()
+
+    def run(self):
+        self.start_server()
+        last_prefetch = 0
+        last_progress = 0
+        last_crawl = time.time() - CATALOG_CRAWL_INTERVAL + CATALOG_CRAWL_DELAY
+        while not self.abortRequested():
+            if self.server and self.server.server.relay and time.time() - last_prefetch >= PREFETCH_INTERVAL:
+                self.prefetch()
+                last_prefetch = time.time()
+            if time.time() - last_progress >= PROGRESS_INTERVAL:
+                self.flush_progress()
+                last_progress = time.time()
+            # The crawl takes a while, it runs in its own thread and the loop keeps serving the rest
+            if self.settings.catalog_crawl and time.time() - last_crawl >= CATALOG_CRAWL_INTERVAL \
+                    and (self.crawl_task is None or self.crawl_task.done()):
+                self.crawl_task = Task(self.crawl_catalog)
+                last_crawl = time.time()
+            if self.waitForAbort(10):
+                break
+        self.stop_server()
+        self.r.close()
+
+
+if __name__ == '__main__':
+    RuutuService().run()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+find_license_url over synthetic multi-period DASH manifests fed in chunks
+
+Run with: python -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resources', 'lib'))
+
+from mpd import find_license_url
+
+LICENSE_URL = 'https://license.example/playready/rightsmanager.asmx?a=1&b=2'
+
+WIDEVINE = ('<ContentProtection schemeIdUri="urn:uuid:edef8ba9-79d6-4ace-a3c8-27dcd51d21ed">'
+            '<cenc:pssh>AAAAW3Bzc2gAAAAA7e+LqXnWSs6jyCfc1R0h7QAAADsIARIQ</cenc:pssh></ContentProtection>')
+PLAYREADY_LAURL = ('<ContentProtection schemeIdUri="urn:uuid:9a04f079-9840-4286-ab92-e65be0885f95">'
+                   '<ms:laurl licenseUrl="%s"/></ContentProtection>' % LICENSE_URL.replace('&', '&amp;'))
+PLAYREADY_LA_URL = ('<ContentProtection schemeIdUri="urn:uuid:9a04f079-9840-4286-ab92-e65be0885f95">'
+                    '<mspr:la_url> %s </mspr:la_url></ContentProtection>' % LICENSE_URL.replace('&', '&amp;'))
+
+
+def manifest(periods, protection_of_period, segments=200):
+    """Manifest with the given number of Periods, protection_of_period(index) gives their ContentProtection."""
+    timeline = ''.join('<S t="%s" d="96000"/>' % (index * 96000) for index in range(segments))
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>'
+             '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" xmlns:cenc="urn:mpeg:cenc:2013" '
+             'xmlns:ms="urn:microsoft:playready" xmlns:mspr="urn:microsoft:playready" type="static">']
+    for index in range(periods):
+        parts.append('<Period id="p%s"><AdaptationSet contentType="video">' % index)
+        parts.append('<ContentProtection schemeIdUri="urn:mpeg:dash:mp4protection:2011" value="cenc"/>')
+        parts.append(protection_of_period(index))
+        parts.append('<Representation id="v%s" bandwidth="3000000"><SegmentTemplate timescale="48000">'
+                     '<SegmentTimeline>%s</SegmentTimeline></SegmentTemplate></Representation>' % (index, timeline))
+        parts.append('</AdaptationSet></Period>')
+    parts.append('</MPD>')
+    return ''.join(parts)
+
+
+class CountingChunks(object):
+    """Iterable over body in chunk_size pieces that remembers how many were taken."""
+
+    def __init__(self, body, chunk_size=16 * 1024):
+        self.chunks = [body[start:start + chunk_size] for start in range(0, len(body), chunk_size)]
+        self.taken = 0
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.taken += 1
+            yield chunk
+
+
+class FindLicenseUrlTest(unittest.TestCase):
+    def test_laurl_after_widevine(self):
+        chunks = CountingChunks(manifest(40, lambda index: WIDEVINE + PLAYREADY_LAURL))
+        self.assertEqual(find_license_url(chunks), LICENSE_URL)
+
+    def test_reordered_content_protection(self):
+        chunks = CountingChunks(manifest(40, lambda index: PLAYREADY_LAURL + WIDEVINE))
+        self.assertEqual(find_license_url(chunks), LICENSE_URL)
+
+    def test_mspr_la_url(self):
+        chunks = CountingChunks(manifest(40, lambda index: WIDEVINE + PLAYREADY_LA_URL))
+        self.assertEqual(find_license_url(chunks), LICENSE_URL)
+
+    def test_stops_at_first_license_url(self):
+        chunks = CountingChunks(manifest(40, lambda index: WIDEVINE + PLAYREADY_LAURL, segments=1000))
+        self.assertGreater(len(chunks.chunks), 50)
+        self.assertEqual(find_license_url(chunks), LICENSE_URL)
+        # The first period fits in a couple of chunks, the other 39 are never read
+        self.assertLessEqual(chunks.taken, 3)
+
+    def test_license_url_only_in_a_later_period(self):
+        chunks = CountingChunks(manifest(40, lambda index: WIDEVINE + (PLAYREADY_LA_URL if index == 25 else '')))
+        self.assertEqual(find_license_url(chunks), LICENSE_URL)
+        self.assertLess(chunks.taken, len(chunks.chunks))
+
+    def test_without_playready(self):
+        chunks = CountingChunks(manifest(5, lambda index: WIDEVINE))
+        self.assertIsNone(find_license_url(chunks))
+        self.assertEqual(chunks.taken, len(chunks.chunks))
+
+
+if __name__ == '__main__':
+    unittest.main()
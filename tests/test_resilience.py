@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Retries, circuit breaker and stale responses of the Ruutu client against a replay server injecting faults
+
+Run with: python -m unittest discover -s tests
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[0:0] = [os.path.join(ROOT_PATH, 'resources', 'lib'), os.path.join(ROOT_PATH, 'benchmarks')]
+
+import requests
+
+import ruutu
+from ruutu import Ruutu, NAVIGATION_URL
+from fixtures import RuutuFixtures
+from replay import ReplayServer, ReplayAdapter
+
+NAVIGATION_PATH = 'prod-component-api.nm-services.nelonenmedia.fi/api/navigation'
+NAVIGATION_HOST = 'prod-component-api.nm-services.nelonenmedia.fi'
+
+
+class ResilienceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ReplayServer(RuutuFixtures())
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.profile = tempfile.mkdtemp(prefix='ruutu-test-')
+        self.r = Ruutu(self.profile)
+        self.r.log_handler = lambda level, string: None
+        self.adapter = ReplayAdapter(self.server.url)
+        self.r.http_session.mount('https://', self.adapter)
+        # No waiting between retries
+        self.backoff_delay = ruutu.backoff_delay
+        ruutu.backoff_delay = lambda attempt: 0
+
+    def tearDown(self):
+        ruutu.backoff_delay = self.backoff_delay
+        self.server.clear_faults()
+        shutil.rmtree(self.profile, ignore_errors=True)
+
+    def requests_to(self, prefix):
+        return sum(count for endpoint, count in self.adapter.stats()['endpoints'].items()
+                   if endpoint.startswith('GET ' + prefix))
+
+    def navigation(self):
+        return self.r.make_request(NAVIGATION_URL, 'get', status=True)
+
+    def expire_navigation(self):
+        key = self.r.cache.make_key(NAVIGATION_URL, None)
+        meta, body = self.r.cache.get(key)
+        self.r.cache.refresh(key, meta, body, -1)
+
+    def test_server_errors_are_retried_a_bounded_number_of_times(self):
+        self.server.inject(NAVIGATION_PATH, status=503)
+        status_code, body = self.navigation()
+        self.assertEqual(status_code, 503)
+        self.assertEqual(self.requests_to(NAVIGATION_PATH), self.r.max_retries + 1)
+
+    def test_retry_succeeds_after_a_transient_error(self):
+        self.server.inject(NAVIGATION_PATH, status=500, times=1)
+        status_code, body = self.navigation()
+        self.assertEqual(status_code, 200)
+        self.assertEqual(self.requests_to(NAVIGATION_PATH), 2)
+        self.assertTrue(self.r.circuit.allow(NAVIGATION_HOST))
+
+    def test_slow_responses_time_out_and_are_retried(self):
+        self.r.timeout = (1, 0.2)
+        self.server.inject(NAVIGATION_PATH, delay=1)
+        self.assertRaises(requests.exceptions.Timeout, self.navigation)
+        self.assertEqual(self.requests_to(NAVIGATION_PATH), self.r.max_retries + 1)
+
+    def test_circuit_opens_after_consecutive_failures(self):
+        self.server.inject(NAVIGATION_PATH, status=503)
+        for _ in range(self.r.circuit.failure_threshold):
+            self.navigation()
+        sent = self.requests_to(NAVIGATION_PATH)
+
+        self.assertRaises(Ruutu.RuutuError, self.navigation)
+        self.assertEqual(self.requests_to(NAVIGATION_PATH), sent)
+
+    def test_half_open_circuit_closes_after_a_successful_trial(self):
+        self.r.circuit.reset_timeout = 0.2
+        self.server.inject(NAVIGATION_PATH, status=503)
+        for _ in range(self.r.circuit.failure_threshold):
+            self.navigation()
+        self.assertFalse(self.r.circuit.allow(NAVIGATION_HOST))
+
+        self.server.clear_faults()
+        time.sleep(0.3)
+        status_code, body = self.navigation()
+        self.assertEqual(status_code, 200)
+        self.assertNotIn(NAVIGATION_HOST, self.r.circuit.hosts)
+
+    def test_half_open_circuit_opens_again_after_a_failed_trial(self):
+        self.r.circuit.reset_timeout = 0.2
+        self.server.inject(NAVIGATION_PATH, status=503)
+        for _ in range(self.r.circuit.failure_threshold):
+            self.navigation()
+
+        time.sleep(0.3)
+        sent = self.requests_to(NAVIGATION_PATH)
+        self.navigation()
+        self.assertGreater(self.requests_to(NAVIGATION_PATH), sent)
+        self.assertRaises(Ruutu.RuutuError, self.navigation)
+
+    def test_stale_response_is_served_on_server_errors(self):
+        status_code, fresh_body = self.navigation()
+        self.expire_navigation()
+
+        self.server.inject(NAVIGATION_PATH, status=503)
+        self.assertEqual(self.navigation(), (200, fresh_body))
+        self.assertEqual(self.requests_to(NAVIGATION_PATH), 1 + self.r.max_retries + 1)
+
+    def test_stale_response_is_served_on_timeouts(self):
+        status_code, fresh_body = self.navigation()
+        self.expire_navigation()
+
+        self.r.timeout = (1, 0.2)
+        self.server.inject(NAVIGATION_PATH, delay=1)
+        self.assertEqual(self.navigation(), (200, fresh_body))
+
+    def test_stale_response_is_served_while_the_circuit_is_open(self):
+        status_code, fresh_body = self.navigation()
+        self.expire_navigation()
+        self.server.inject(NAVIGATION_PATH, status=503)
+        for _ in range(self.r.circuit.failure_threshold):
+            self.navigation()
+        sent = self.requests_to(NAVIGATION_PATH)
+
+        self.assertEqual(self.navigation(), (200, fresh_body))
+        self.assertEqual(self.requests_to(NAVIGATION_PATH), sent)
+
+
+if __name__ == '__main__':
+    unittest.main()